@@ -0,0 +1,719 @@
+"""
+Benchmarks for the scraper, e.g. python benchmarks.py parse --pages 200 --workers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+
+import bs4
+from colorama import Fore
+
+import scrape
+from fetch import percentile
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+FIXTURE = os.path.join(REPO, 'scratch.html')
+IMPORT_BUDGET = 1.0  # seconds allowed for `import scrape`, dependencies included
+
+
+def load_fixture():
+    """
+    Load the saved register page used as a benchmark fixture
+    :return: html of one page of the register
+    """
+    with open(FIXTURE, encoding='utf-8') as file:
+        return file.read()
+
+
+def people_fixture():
+    """
+    The fixture rewritten as a pharmacist/assistant page (addresses inside html comments, pre 12/1/22)
+    :return: html of one page of the register
+    """
+    html = load_fixture()
+    return html.replace('<small>', '<!-- <small>').replace('</small>', '</small> -->')
+
+
+def timed(function, *args):
+    """
+    Time a single call
+    :param function: function to call
+    :param args: arguments to pass
+    :return: return value, seconds taken
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_parse(pages, workers):
+    """
+    Compare serial parsing with a process pool, on the fixture repeated as many times as pages
+    :param pages: number of pages to parse
+    :param workers: worker processes in the pool
+    """
+    html_list = [load_fixture()] * pages
+    serial, serial_time = timed(lambda: [scrape.extract_page(h) for h in html_list])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(scrape.extract_page, html_list[:workers]))  # start the workers before timing
+        parallel, parallel_time = timed(lambda: list(executor.map(scrape.extract_page, html_list)))
+    if parallel != serial:
+        raise AssertionError('process pool output differs from serial output')
+    print(f'serial:   {pages} pages in {serial_time:.2f}s ({1000 * serial_time / pages:.1f}ms/page)')
+    print(f'parallel: {pages} pages in {parallel_time:.2f}s ({1000 * parallel_time / pages:.1f}ms/page,'
+          f' {workers} workers)')
+    print(Fore.GREEN + f'speed-up x{serial_time / parallel_time:.2f}, output identical' + Fore.RESET)
+
+
+def golden(html):
+    """
+    Check the xpath parser gives byte-identical records to the bs4 parser
+    :param html: html of one page of the register
+    :return: number of records compared
+    """
+    expected = json.dumps(scrape.extract_page(html, engine='bs4'), indent=2)
+    actual = json.dumps(scrape.extract_page(html, engine='xpath'), indent=2)
+    if actual != expected:
+        raise AssertionError('xpath parser output differs from bs4 parser output')
+    return len(json.loads(expected))
+
+
+def bench_engines(pages):
+    """
+    Golden test of the two parser engines on both fixtures, then time each on the fixture
+    :param pages: number of pages to parse with each engine
+    """
+    for fixture_name, html in (('pharmacy', load_fixture()), ('people', people_fixture())):
+        print(Fore.GREEN + f'{fixture_name}: {golden(html)} records identical' + Fore.RESET)
+    html = load_fixture()
+    times = {}
+    for engine in ('bs4', 'xpath'):
+        _, times[engine] = timed(lambda: [scrape.extract_page(html, engine) for _ in range(pages)])
+        print(f'{engine}: {pages} pages in {times[engine]:.2f}s ({1000 * times[engine] / pages:.1f}ms/page)')
+    print(Fore.GREEN + f'speed-up x{times["bs4"] / times["xpath"]:.2f}' + Fore.RESET)
+
+
+def bench_address(repeat):
+    """
+    Per-item cost of reading addresses out of html comments: parsing each comment vs reading its text
+    :param repeat: times to run over the comments on the people fixture
+    """
+    soup = scrape.html_to_soup(people_fixture())
+    comments = soup.find_all(string=lambda text: isinstance(text, bs4.Comment) and '<small>' in text)
+    before = [bs4.BeautifulSoup(c, scrape.PARSER).small.string for c in comments]
+    after = [scrape.small_from_comment(c) for c in comments]
+    if [scrape.clean_address(a) for a in after] != [scrape.clean_address(b) for b in before]:
+        raise AssertionError('addresses differ')
+    items = repeat * len(comments)
+    _, before_time = timed(lambda: [bs4.BeautifulSoup(c, scrape.PARSER).small.string
+                                    for _ in range(repeat) for c in comments])
+    _, after_time = timed(lambda: [scrape.small_from_comment(c) for _ in range(repeat) for c in comments])
+    print(f'parse comment: {1e6 * before_time / items:.1f}\u00b5s/item')
+    print(f'read comment:  {1e6 * after_time / items:.1f}\u00b5s/item')
+    print(Fore.GREEN + f'speed-up x{before_time / after_time:.0f}, addresses identical' + Fore.RESET)
+
+
+def bench_import(repeat, budget=IMPORT_BUDGET):
+    """
+    Time `import scrape` in a fresh interpreter, in a directory with no data/ folder,
+    and fail if it's over budget or loads any snapshot
+    :param repeat: fresh interpreters to start (best time is used)
+    :param budget: seconds allowed
+    """
+    code = ('import sys, time; sys.path.insert(0, sys.argv[1]); start = time.perf_counter(); import scrape; '
+            'print(time.perf_counter() - start, len(scrape._last_snapshots))')
+    times = []
+    with tempfile.TemporaryDirectory() as empty_dir:
+        for _ in range(repeat):
+            reply = subprocess.run([sys.executable, '-c', code, REPO], cwd=empty_dir, timeout=60,
+                                   capture_output=True, text=True, check=True)
+            seconds, loaded = reply.stdout.split()
+            if int(loaded):
+                raise AssertionError('importing scrape loaded a snapshot')
+            times.append(float(seconds))
+    print(f'import scrape: {min(times):.3f}s (budget {budget:.3f}s)')
+    if min(times) > budget:
+        print(Fore.LIGHTRED_EX + 'over budget' + Fore.RESET)
+        sys.exit(1)
+
+
+def synthetic_register(records):
+    """
+    A register of distinct pharmacies built from the fixture, for when no real snapshot is to hand
+    :param records: number of records wanted
+    :return: list of data objects
+    """
+    page = scrape.extract_page(load_fixture())
+    register = []
+    for n in range(records):
+        record = json.loads(json.dumps(page[n % len(page)]))
+        record['Name'] = f"{record['Name']} {n}"
+        record[next(k for k in record if 'Registration Number' in k)] = 10000 + n
+        register.append(record)
+    return register
+
+
+def bench_formats(file_name, records, repeat):
+    """
+    Store size and load time of a snapshot as indent=2 JSON vs msgpack
+    :param file_name: JSON snapshot to use (synthetic register if None)
+    :param records: size of the synthetic register
+    :param repeat: loads to time (best time is used)
+    """
+    from binary_snapshots import read_msgpack, write_msgpack
+    if file_name is None:
+        data = synthetic_register(records)
+    else:
+        with open(file_name) as file:
+            data = json.load(file)
+    with tempfile.TemporaryDirectory() as tmp:
+        json_file, packed_file = os.path.join(tmp, 'snapshot.json'), os.path.join(tmp, 'snapshot.msgpack')
+        scrape.write_to_json(data, json_file)
+        write_msgpack(data, packed_file)
+        if read_msgpack(packed_file) != data or list(map(list, read_msgpack(packed_file))) != list(map(list, data)):
+            raise AssertionError('msgpack snapshot does not round-trip')
+
+        def load_json():
+            with open(json_file) as file:
+                return json.load(file)
+
+        json_time = min(timed(load_json)[1] for _ in range(repeat))
+        packed_time = min(timed(read_msgpack, packed_file)[1] for _ in range(repeat))
+        json_size, packed_size = os.path.getsize(json_file), os.path.getsize(packed_file)
+    print(f'{len(data)} records')
+    print(f'json:    {json_size / 1e6:.2f}MB, loads in {1000 * json_time:.0f}ms')
+    print(f'msgpack: {packed_size / 1e6:.2f}MB, loads in {1000 * packed_time:.0f}ms')
+    print(Fore.GREEN + f'x{json_size / packed_size:.1f} smaller, x{json_time / packed_time:.1f} faster to load,'
+                       f' round-trips' + Fore.RESET)
+
+
+def retained(build):
+    """
+    Memory held by what a function returns, once anything it used along the way is freed
+    :param build: function of no arguments
+    :return: return value, bytes allocated and still held
+    """
+    import tracemalloc
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, held
+
+
+def bench_records(file_name, register, records):
+    """
+    Memory per record of a snapshot held as dicts vs records.Pharmacy/Pharmacist/Assistant,
+    checking the records give back the same JSON
+    :param file_name: JSON snapshot to use (synthetic register if None)
+    :param register: assistant, pharmacist or pharmacy
+    :param records: size of the synthetic register
+    """
+    import mock_psi
+    from records import RECORD_TYPES, from_dicts, to_dicts
+    if file_name is None:
+        text = json.dumps(synthetic_register(records) if register == 'pharmacy'
+                          else mock_psi.synthetic_records(register, records))
+    else:
+        with open(file_name) as file:
+            text = file.read()
+    data, dict_bytes = retained(lambda: json.loads(text))
+    compact, record_bytes = retained(lambda: from_dicts(json.loads(text), RECORD_TYPES[register]))
+    if json.dumps(to_dicts(compact)) != json.dumps(data):
+        raise AssertionError('records do not round-trip')
+    print(f'{len(data)} {register} records')
+    print(f'dicts:   {dict_bytes / len(data):.0f} bytes/record')
+    print(f'records: {record_bytes / len(data):.0f} bytes/record')
+    print(Fore.GREEN + f'x{dict_bytes / record_bytes:.1f} smaller, round-trips' + Fore.RESET)
+
+
+def chain_register(records, seed=0):
+    """
+    Pharmacies with owners, Companies Office numbers and superintendents shared the way chains share them
+    :param records: number of pharmacies
+    :param seed: random seed
+    :return: pharmacies, pharmacists
+    """
+    import random
+    random_ = random.Random(seed)
+    pharmacies = []
+    for n in range(records):
+        chain = random_.randrange(records // 5 + 1)  # about 1 in 5 pharmacies in a chain of its own
+        pharmacies.append({'Name': f'Pharmacy {n}', 'Address': f'{n} Main Street',
+                           'Superintendent Pharmacist': f'Superintendent {chain}' if n % 3 else f'Owner {n}',
+                           'Pharmacy Owner': f'Owner {chain}' if n % 2 else f'Owner {n}',
+                           'Companies Office Registration No': chain if n % 5 else None,
+                           'PSI Registration Number': n})
+    pharmacists = [{'Name': f'Superintendent {n}'} for n in range(records // 5 + 1)]
+    pharmacists.append({'Name': 'Superintendent 1'})  # two of the same name: that superintendent doesn't link
+    return pharmacies, pharmacists
+
+
+def naive_chains(pharmacies, pharmacists, keys):
+    """
+    Chains by merging groups of equal values until nothing changes (the reference, quadratic or worse)
+    :return: set of chains, as frozensets of registration numbers
+    """
+    groups = [{p['PSI Registration Number']} for p in pharmacies]
+    for key in keys:
+        for value in {p[key] for p in pharmacies if p[key] is not None}:
+            if key == 'Superintendent Pharmacist' and len([ph for ph in pharmacists if ph['Name'] == value]) != 1:
+                continue
+            groups.append({p['PSI Registration Number'] for p in pharmacies if p[key] == value})
+    merged = True
+    while merged:
+        merged = False
+        for i, group in enumerate(groups):
+            for other in groups[i + 1:]:
+                if group & other:
+                    group |= other
+                    groups.remove(other)
+                    merged = True
+                    break
+            if merged:
+                break
+    return {frozenset(g) for g in groups if len(g) > 1}
+
+
+def bench_chains(records):
+    """
+    Golden test of chains.find_chains against naive merging on a small register, then time it on
+    registers of growing size to show it scales linearly
+    :param records: size of the largest register timed
+    """
+    from chains import LINKING_KEYS, find_chains, write_workbook
+    pharmacies, pharmacists = chain_register(300)
+    expected = naive_chains(pharmacies, pharmacists, LINKING_KEYS)
+    actual = {frozenset(p['PSI Registration Number'] for p in chain)
+              for _, chain in find_chains(pharmacies, pharmacists)}
+    if actual != expected:
+        raise AssertionError('find_chains differs from naive merging')
+    print(Fore.GREEN + f'{len(actual)} chains of 300 pharmacies identical' + Fore.RESET)
+    for n in (records // 4, records // 2, records):
+        pharmacies, pharmacists = chain_register(n)
+        chains, seconds = timed(find_chains, pharmacies, pharmacists)
+        print(f'{n} pharmacies: {len(chains)} chains in {1000 * seconds:.0f}ms'
+              f' ({1e6 * seconds / n:.1f}\u00b5s/pharmacy)')
+    with tempfile.TemporaryDirectory() as tmp:
+        _, seconds = timed(write_workbook, chains, os.path.join(tmp, 'chains.xlsx'))
+    print(f'chains.xlsx written in {seconds:.2f}s')
+
+
+def people(records):
+    """
+    :param records: number of records
+    :return: generator of synthetic pharmacist records, made as they're asked for
+    """
+    for n in range(records):
+        yield {'Name': f'Pharmacist {n}', 'Address': f'{n % 500} Main Street, Co. Wicklow',
+               'Registration Number': 10000 + n, 'Date Registered': f'{1 + n % 28:02d}/{1 + n % 12:02d}/1990',
+               'Section 77 Registration': n % 50 == 0}
+
+
+def bench_export(records):
+    """
+    Peak memory and time of writing a register to xlsx and csv, streamed, at growing sizes (flat peak memory
+    shows rows aren't held), and a check that the files hold the records in the fixed columns
+    :param records: size of the largest register written
+    """
+    import csv
+    import tracemalloc
+    from openpyxl import load_workbook
+    from export import SCHEMAS, field, write_csv, write_xlsx
+    with tempfile.TemporaryDirectory() as tmp:
+        xlsx, csv_file = os.path.join(tmp, 'register.xlsx'), os.path.join(tmp, 'register.csv')
+        for n in (records // 10, records):
+            for name, write in (('xlsx', lambda: write_xlsx([('pharmacist', 'pharmacist', people(n))], xlsx)),
+                                ('csv', lambda: write_csv(people(n), 'pharmacist', csv_file))):
+                written, seconds = timed(write)
+                tracemalloc.start()  # slows writing down, so timed apart
+                write()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print(f'{name}: {written} records in {seconds:.2f}s, peak {peak / 1e6:.1f}MB')
+        expected = [tuple(h for h, _ in SCHEMAS['pharmacist'])]
+        expected += [tuple(field(r, f) for _, f in SCHEMAS['pharmacist']) for r in people(records)]
+        if list(load_workbook(xlsx, read_only=True).active.values) != expected:
+            raise AssertionError('xlsx rows differ from the records')
+        with open(csv_file, newline='', encoding='utf-8') as file:
+            if list(csv.reader(file)) != [[str(v) for v in row] for row in expected]:
+                raise AssertionError('csv rows differ from the records')
+    print(Fore.GREEN + 'xlsx and csv hold every record, in the fixed columns' + Fore.RESET)
+
+
+def foi_workbook(file_name, records):
+    """
+    Write an FOI-style workbook: the No SV, No SI and No SI & SV sheets, with dates in a date column
+    (not write-only: that leaves out the sheet dimensions and shared strings Excel writes)
+    :param file_name: name of xlsx file
+    :param records: rows in each sheet
+    """
+    from datetime import datetime
+    from openpyxl import Workbook
+    workbook = Workbook()
+    workbook.remove(workbook.active)
+    for title in ('No SV', 'No SI', 'No SI & SV'):
+        worksheet = workbook.create_sheet(title)
+        worksheet.append(('Reg', 'Pharmacy', 'Address', 'Date removed'))
+        for n in range(records):
+            worksheet.append((5000 + n, f'Pharmacy {n}', f'{n} Main Street, Co. Wicklow',
+                              datetime(2021, 1, 1) + timedelta(days=n % 365)))
+    workbook.save(file_name)
+
+
+def read_foi_before(file_name):
+    """
+    excel_reader.py as it was: whole workbook loaded, header from list(sheet.values), a try per cell
+    :param file_name: name of xlsx file
+    :return: dict of worksheet title to list of data objects
+    """
+    from datetime import datetime
+    from openpyxl import load_workbook
+    workbook = load_workbook(filename=file_name)
+    sheets = {}
+    for sheet in workbook:
+        keys = list(sheet.values)[0]
+        obj_list = []
+        for row in sheet.iter_rows(min_row=2, values_only=True):
+            obj = {}
+            for i, r in enumerate(row):
+                try:
+                    r = datetime.strftime(r, '%Y-%m-%d')
+                except TypeError:
+                    pass
+                obj[keys[i]] = r
+            obj_list.append(obj)
+        sheets[sheet.title] = obj_list
+    return sheets
+
+
+def bench_foi(records):
+    """
+    Golden test and timing of excel_reader.read_workbook against the old reader, on a generated FOI workbook
+    :param records: rows in each sheet
+    """
+    from excel_reader import read_workbook
+    with tempfile.TemporaryDirectory() as tmp:
+        file_name = os.path.join(tmp, 'foi.xlsx')
+        foi_workbook(file_name, records)
+        before, before_time = timed(read_foi_before, file_name)
+        after, after_time = timed(lambda: dict(read_workbook(file_name)))
+    if json.dumps(after) != json.dumps(before):
+        raise AssertionError('excel_reader output differs from the old reader')
+    rows = sum(len(sheet) for sheet in after.values())
+    print(f'before: {rows} rows in {before_time:.2f}s')
+    print(f'after:  {rows} rows in {after_time:.2f}s')
+    print(Fore.GREEN + f'speed-up x{before_time / after_time:.1f}, records identical' + Fore.RESET)
+
+
+def strptime_hours(day, times):
+    """
+    Hours open on one day as get_opening_hours worked them out before opening_hours.day_hours (the reference)
+    :param day: day name
+    :param times: dict of Open, Closed and maybe Lunch Closure and Lunch Reopen
+    :return: hours open
+    """
+    from datetime import datetime
+    hours_open = 0
+    try:
+        open_ = datetime.strptime(times['Open'], '%H:%M')
+        closed = datetime.strptime(times['Closed'], '%H:%M')
+        if open_ > closed > datetime(1900, 1, 1) or closed == datetime(1900, 1, 1, 10):
+            closed += timedelta(hours=12)
+        hours = (closed - open_) / timedelta(hours=1)
+        hours %= 24
+        if day != 'Bank Holidays':
+            hours_open += hours
+        try:
+            lunch1 = datetime.strptime(times['Lunch Closure'], '%H:%M')
+            lunch2 = datetime.strptime(times['Lunch Reopen'], '%H:%M')
+            hours = (lunch2 - lunch1) / timedelta(hours=1)
+            if hours > 0:
+                hours %= 24
+                hours_open -= hours
+        except KeyError:
+            pass
+    except TypeError:
+        pass
+    return hours_open
+
+
+HOURS_EDGE_CASES = [  # (day, times) the register has been seen to show, or could
+    ('Monday', {'Open': '09:00', 'Closed': '18:00'}),
+    ('Monday', {'Open': '09:00', 'Closed': '06:00'}),  # closing before opening: pm
+    ('Monday', {'Open': '08:00', 'Closed': '10:00'}),  # 10:00 is always taken as pm
+    ('Monday', {'Open': '9:30', 'Closed': '5:5'}),  # single digits
+    ('Tuesday', {'Open': '09:00', 'Closed': '00:00'}),  # midnight
+    ('Tuesday', {'Open': '00:00', 'Closed': '00:00'}),
+    ('Tuesday', {'Open': '22:00', 'Closed': '02:00'}),  # past midnight
+    ('Wednesday', {'Open': '09:00', 'Lunch Closure': '13:00', 'Lunch Reopen': '14:00', 'Closed': '18:00'}),
+    ('Wednesday', {'Open': '09:00', 'Lunch Closure': '14:00', 'Lunch Reopen': '13:00', 'Closed': '18:00'}),
+    ('Wednesday', {'Open': '09:00', 'Lunch Closure': '13:00', 'Lunch Reopen': '13:00', 'Closed': '18:00'}),
+    ('Thursday', {'Open': '09:00', 'Lunch Closure': None, 'Lunch Reopen': None, 'Closed': '18:00'}),
+    ('Thursday', {'Open': '09:00', 'Lunch Closure': '13:00', 'Closed': '18:00'}),  # reopening time missing
+    ('Friday', {'Open': None, 'Closed': None}),  # closed
+    ('Friday', {'Open': '09:00', 'Closed': None}),
+    ('Bank Holidays', {'Open': '10:00', 'Closed': '14:00'}),  # only lunch counts on bank holidays
+    ('Bank Holidays', {'Open': '10:00', 'Lunch Closure': '13:00', 'Lunch Reopen': '14:00', 'Closed': '18:00'}),
+]
+
+
+def bench_hours(records, repeat):
+    """
+    Golden test of opening_hours.day_hours against the strptime version, on edge cases and a synthetic
+    register, then time both
+    :param records: size of the synthetic register
+    :param repeat: passes over the register to time (best time is used)
+    """
+    from opening_hours import day_hours
+    for day, times in HOURS_EDGE_CASES:
+        if day_hours(day, times) != strptime_hours(day, times):
+            raise AssertionError(f'{day} {times}: {day_hours(day, times)} != {strptime_hours(day, times)}')
+    register = synthetic_register(records)
+    register.append({'Opening Hours': dict(HOURS_EDGE_CASES[:1] + HOURS_EDGE_CASES[-2:])})
+    register.extend({'Opening Hours': {day: times}} for day, times in HOURS_EDGE_CASES)
+    days = [(day, times) for r in register for day, times in r['Opening Hours'].items() if day != 'Weekly Hours']
+    expected = [strptime_hours(day, times) for day, times in days]
+    if [day_hours(day, times) for day, times in days] != expected:
+        raise AssertionError('day_hours differs from the strptime version')
+    print(Fore.GREEN + f'{len(HOURS_EDGE_CASES)} edge cases and {len(days)} days identical' + Fore.RESET)
+    old_time = min(timed(lambda: [strptime_hours(d, t) for d, t in days])[1] for _ in range(repeat))
+    new_time = min(timed(lambda: [day_hours(d, t) for d, t in days])[1] for _ in range(repeat))
+    print(f'strptime:  {1e6 * old_time / len(days):.2f}\u00b5s/day')
+    print(f'day_hours: {1e6 * new_time / len(days):.2f}\u00b5s/day')
+    print(Fore.GREEN + f'speed-up x{old_time / new_time:.1f}' + Fore.RESET)
+
+
+def profiled_work(n):
+    """
+    CPU work for bench_profile to find in a profile
+    :param n: size of the work
+    :return: sum of squares below n
+    """
+    return sum(i * i for i in range(n))
+
+
+def bench_profile(tasks):
+    """
+    Check that a profiled stage entered by many tasks at once (as pharmacy.fetch is) and a profiled stage
+    nested in another (pharmacy.parse in pharmacy) are profiled to the last exit without the profiler
+    being switched on twice (an error from Python 3.12) or switched off early
+    :param tasks: tasks entering the stage together
+    """
+    import pstats
+    from metrics import RunMetrics
+    metrics = RunMetrics(('pharmacy', 'pharmacy.fetch', 'pharmacy.parse'))
+
+    async def fetch(i):
+        with metrics.stage('pharmacy.fetch'):
+            await asyncio.sleep(0.001 * i)
+            profiled_work(1000 * (i + 1))
+
+    async def crawl():
+        await asyncio.gather(*(fetch(i) for i in range(tasks)))
+
+    asyncio.run(crawl())
+    with metrics.stage('pharmacy'):
+        with metrics.stage('pharmacy.parse'):
+            profiled_work(1000)
+    if sys.getprofile() is not None:
+        raise AssertionError('profiler left running')
+    calls = pstats.Stats(metrics.profiles['pharmacy.fetch']).stats
+    work = next((stats for (_, _, function), stats in calls.items() if function == 'profiled_work'), None)
+    if work is None or work[1] != tasks:
+        raise AssertionError(f'{tasks} profiled_work calls in the pharmacy.fetch profile, {work and work[1]} found')
+    if metrics.counters['pharmacy.parse.not profiled (inside pharmacy)'] != 1:
+        raise AssertionError('nested stage not counted as unprofiled')
+    print(Fore.GREEN + f'{tasks} overlapping calls of pharmacy.fetch in one profile, to the last exit;'
+                       f' pharmacy.parse inside pharmacy left to its profile' + Fore.RESET)
+
+
+def crawl_register(register, url, parse_workers):
+    """
+    Fetch and parse one register from a mock server, in the current folder (a scratch copy of data/),
+    and print the measurements as json (run in a fresh interpreter so peak RSS is this register's alone)
+    :param register: assistant, pharmacist or pharmacy
+    :param url: search page of the mock server
+    :param parse_workers: worker processes for parsing (0 to parse in a thread)
+    """
+    import resource
+    from fetch import FetchEngine
+    from metrics import RunMetrics
+    scrape.BASE_URL = url
+    scrape.CACHE_RESPONSES = False
+    scrape._metrics = metrics = RunMetrics()
+    data_type = {str(d): d for d in (scrape.assistant, scrape.pharmacist, scrape.pharmacy)}[register]
+    sizes = []
+    fetch_register_page = scrape.fetch_register_page
+
+    async def counted_fetch_register_page(*args, **kwargs):
+        html = await fetch_register_page(*args, **kwargs)
+        if html is not None:
+            sizes.append(len(html.encode()))
+        return html
+
+    async def crawl():
+        async with FetchEngine() as engine:
+            await scrape.get_data(data_type, engine, parse_workers, incremental=False)
+
+    scrape.fetch_register_page = counted_fetch_register_page
+    _, seconds = timed(asyncio.run, crawl())
+    print(json.dumps({'register': register, 'pages': len(sizes), 'records': data_type.records, 'seconds': seconds,
+                      'bytes': sum(sizes), 'parse_times': metrics.timings.get(f'{register}.parse', []),
+                      'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+
+
+def free_port():
+    """
+    :return: a TCP port nothing is listening on
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(url, timeout=60):
+    """
+    Wait until a server answers
+    :param url: URL to poll
+    :param timeout: seconds to wait
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(url):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def bench_e2e(registers, records, latency, jitter, error_rate, parse_workers):
+    """
+    Run get_data end to end against the mock PSI server, for each register in turn:
+    throughput, bytes downloaded, parse time per page (get_data's parse stage, so a worker's round trip
+    is counted too) and peak RSS
+    :param registers: registers to crawl
+    :param records: records in each (synthetic) register
+    :param latency: seconds the mock server adds to every reply
+    :param jitter: up to this many seconds more, at random
+    :param error_rate: share of requests the mock server answers 503
+    :param parse_workers: worker processes for parsing (0 to parse in a thread)
+    """
+    from mock_psi import synthetic_records
+    yesterday = str(date.today() - timedelta(days=1))
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, 'data'))
+        snapshots = []
+        for register in registers:  # served by the mock, and yesterday's scrape for the diff and vacancies
+            file_name = os.path.join(tmp, 'data', f'{register}-data-{yesterday}.json')
+            scrape.write_to_json(synthetic_records(register, records), file_name)
+            snapshots += ['--snapshot', f'{register}={file_name}']
+        server = subprocess.Popen([sys.executable, os.path.join(REPO, 'mock_psi.py'), '--port', str(port),
+                                   '--records', '0', '--latency', str(latency), '--jitter', str(jitter),
+                                   '--error-rate', str(error_rate), '--seed', '0'] + snapshots,
+                                  stdout=subprocess.DEVNULL)
+        try:
+            wait_for_server(f'http://127.0.0.1:{port}/stats')
+            code = 'import sys; sys.path.insert(0, sys.argv[1]); import benchmarks; ' \
+                   'benchmarks.crawl_register(sys.argv[2], sys.argv[3], int(sys.argv[4]))'
+            for register in registers:
+                reply = subprocess.run([sys.executable, '-c', code, REPO, register,
+                                        f'http://127.0.0.1:{port}/search-register/', str(parse_workers)],
+                                       cwd=tmp, capture_output=True, text=True, check=True)
+                result = json.loads(reply.stdout.strip().splitlines()[-1])
+                parse_times = result['parse_times']
+                print(f"{register}: {result['records']} records, {result['pages']} pages in {result['seconds']:.2f}s"
+                      f" ({result['pages'] / result['seconds']:.0f} pages/s,"
+                      f" {result['bytes'] / 1e6 / result['seconds']:.1f}MB/s)")
+                print(f'  parse {1000 * sum(parse_times) / len(parse_times):.1f}ms/page'
+                      f' (p95 {1000 * percentile(parse_times, 95):.1f}ms),'
+                      f" peak RSS {result['peak_rss_mb']:.0f}MB")
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/stats') as reply:
+                stats = json.load(reply)
+            print(Fore.GREEN + f"server: {stats['requests']} requests, {stats['errors']} errors,"
+                               f" {stats['bytes'] / 1e6:.1f}MB" + Fore.RESET)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+    parse = commands.add_parser('parse', help='serial vs process pool parsing')
+    parse.add_argument('--pages', type=int, default=200)
+    parse.add_argument('--workers', type=int, default=os.cpu_count())
+    engines = commands.add_parser('engines', help='golden test and timing of bs4 vs xpath parsing')
+    engines.add_argument('--pages', type=int, default=100)
+    address = commands.add_parser('address', help='per-item cost of addresses in html comments')
+    address.add_argument('--repeat', type=int, default=200)
+    import_ = commands.add_parser('import', help='import time of scrape.py, checked against a budget')
+    import_.add_argument('--repeat', type=int, default=5)
+    formats = commands.add_parser('formats', help='store size and load time, json vs msgpack')
+    formats.add_argument('--file', help='json snapshot to use (default: synthetic register)')
+    formats.add_argument('--records', type=int, default=20000)
+    formats.add_argument('--repeat', type=int, default=5)
+    records = commands.add_parser('records', help='memory per record, dicts vs __slots__ records')
+    records.add_argument('--file', help='json snapshot to use (default: synthetic register)')
+    records.add_argument('--register', choices=['assistant', 'pharmacist', 'pharmacy'], default='pharmacy')
+    records.add_argument('--records', type=int, default=20000)
+    chains = commands.add_parser('chains', help='golden test and scaling of chain clustering')
+    chains.add_argument('--records', type=int, default=40000)
+    export = commands.add_parser('export', help='streamed xlsx/csv export, memory and time')
+    export.add_argument('--records', type=int, default=100000)
+    foi = commands.add_parser('foi', help='golden test and timing of FOI workbook ingestion')
+    foi.add_argument('--records', type=int, default=20000)
+    hours = commands.add_parser('hours', help='golden test and timing of opening hours, strptime vs day_hours')
+    hours.add_argument('--records', type=int, default=20000)
+    hours.add_argument('--repeat', type=int, default=5)
+    profile = commands.add_parser('profile', help='check of profiled stages entered concurrently or nested')
+    profile.add_argument('--tasks', type=int, default=50)
+    e2e = commands.add_parser('e2e', help='get_data end to end against the mock PSI server')
+    e2e.add_argument('--registers', nargs='+', default=['assistant', 'pharmacist', 'pharmacy'])
+    e2e.add_argument('--records', type=int, default=2000)
+    e2e.add_argument('--latency', type=float, default=0.02)
+    e2e.add_argument('--jitter', type=float, default=0.02)
+    e2e.add_argument('--error-rate', type=float, default=0.0)
+    e2e.add_argument('--workers', type=int, default=0, help='parse worker processes (0 parses in a thread)')
+    args = parser.parse_args()
+    if args.command == 'parse':
+        bench_parse(args.pages, args.workers)
+    elif args.command == 'engines':
+        bench_engines(args.pages)
+    elif args.command == 'address':
+        bench_address(args.repeat)
+    elif args.command == 'import':
+        bench_import(args.repeat)
+    elif args.command == 'formats':
+        bench_formats(args.file, args.records, args.repeat)
+    elif args.command == 'records':
+        bench_records(args.file, args.register, args.records)
+    elif args.command == 'chains':
+        bench_chains(args.records)
+    elif args.command == 'export':
+        bench_export(args.records)
+    elif args.command == 'foi':
+        bench_foi(args.records)
+    elif args.command == 'hours':
+        bench_hours(args.records, args.repeat)
+    elif args.command == 'profile':
+        bench_profile(args.tasks)
+    elif args.command == 'e2e':
+        bench_e2e(args.registers, args.records, args.latency, args.jitter, args.error_rate, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Compact binary snapshots: msgpack, with each distinct layout of keys (a "shape", nested dicts included)
+stored once and every record stored as a flat row of values against its shape
+"""
+import msgpack
+
+FORMAT_VERSION = 1
+
+
+def shape_of(record):
+    """
+    :param record: data object (nested dicts allowed, e.g. Opening Hours)
+    :return: tuple of (key, shape of the nested dict or None) pairs
+    """
+    return tuple((key, shape_of(value) if isinstance(value, dict) else None) for key, value in record.items())
+
+
+def flat_values(record, row):
+    """
+    Append a record's values to a row, nested dicts depth first
+    :param record: data object
+    :param row: list to append to
+    """
+    for value in record.values():
+        if isinstance(value, dict):
+            flat_values(value, row)
+        else:
+            row.append(value)
+
+
+def decoder_source(shape, position):
+    """
+    Python expression rebuilding a record of this shape from a row r, e.g. {'Name': r[1], 'Address': r[2]}
+    :param shape: shape of the record
+    :param position: list holding the index of the next value in the row (advanced)
+    :return: source code of the expression
+    """
+    items = []
+    for key, nested in shape:
+        if nested is None:
+            items.append(f'{key!r}: r[{position[0]}]')
+            position[0] += 1
+        else:
+            items.append(f'{key!r}: {decoder_source(nested, position)}')
+    return '{' + ', '.join(items) + '}'
+
+
+def decoder(shape):
+    """
+    Compile a function rebuilding records of one shape from their rows (row[0] is the shape id)
+    :param shape: shape of the record
+    :return: function taking a row and returning a data object
+    """
+    return eval(f'lambda r: {decoder_source(shape, [1])}')
+
+
+def shape_to_list(shape):
+    """
+    :param shape: shape of a record
+    :return: the shape as nested lists, for msgpack
+    """
+    return [[key, None if nested is None else shape_to_list(nested)] for key, nested in shape]
+
+
+def shape_from_list(shape):
+    """
+    :param shape: shape as stored by shape_to_list
+    :return: shape of a record
+    """
+    return tuple((key, None if nested is None else shape_from_list(nested)) for key, nested in shape)
+
+
+def pack(records):
+    """
+    :param records: list of data objects
+    :return: msgpack bytes
+    """
+    shapes, shape_ids, rows = [], {}, []
+    for record in records:
+        shape = shape_of(record)
+        shape_id = shape_ids.get(shape)
+        if shape_id is None:
+            shape_id = shape_ids[shape] = len(shapes)
+            shapes.append(shape)
+        row = [shape_id]
+        flat_values(record, row)
+        rows.append(row)
+    return msgpack.packb({
+        'version': FORMAT_VERSION,
+        'shapes': [shape_to_list(shape) for shape in shapes],
+        'rows': rows,
+    }, use_bin_type=True)
+
+
+def unpack(data):
+    """
+    :param data: msgpack bytes written by pack
+    :return: list of data objects, equal to the ones packed (key order included)
+    """
+    snapshot = msgpack.unpackb(data, raw=False)
+    if snapshot['version'] != FORMAT_VERSION:
+        raise ValueError(f"unsupported snapshot format version {snapshot['version']}")
+    decoders = [decoder(shape_from_list(shape)) for shape in snapshot['shapes']]
+    return [decoders[row[0]](row) for row in snapshot['rows']]
+
+
+def write_msgpack(records, file_name):
+    """
+    Write a snapshot in the binary format
+    :param records: list of data objects
+    :param file_name: name of msgpack file
+    """
+    with open(file_name, 'wb') as file:
+        file.write(pack(records))
+
+
+def read_msgpack(file_name):
+    """
+    Read a snapshot written by write_msgpack
+    :param file_name: name of msgpack file
+    :return: list of data objects
+    """
+    with open(file_name, 'rb') as file:
+        return unpack(file.read())
@@ -0,0 +1,89 @@
+"""
+Pharmacies grouped into chains: any two sharing a Companies Office number, an owner or a superintendent
+are in the same chain, and so on through every link (union-find over hash indexes, one pass of the register)
+"""
+from collections import Counter
+
+from export import write_xlsx
+
+LINKING_KEYS = ('Companies Office Registration No', 'Pharmacy Owner', 'Superintendent Pharmacist')
+SUPERINTENDENT = 'Superintendent Pharmacist'
+
+
+class UnionFind:
+    """
+    Disjoint sets of 0..n-1 (union by size, path halving)
+    """
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return
+        if self.size[i] < self.size[j]:
+            i, j = j, i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+
+    def groups(self):
+        """
+        :return: list of sets (as lists, members in order), in order of their first member
+        """
+        groups = {}
+        for i in range(len(self.parent)):
+            groups.setdefault(self.find(i), []).append(i)
+        return list(groups.values())
+
+
+def find_chains(pharmacies, pharmacists=(), keys=LINKING_KEYS):
+    """
+    Group pharmacies that share any linking value. A superintendent only links pharmacies if their name
+    is that of exactly one registered pharmacist (otherwise the name can't say who it is)
+    :param pharmacies: list of pharmacy data objects
+    :param pharmacists: list of pharmacist data objects
+    :param keys: fields that link pharmacies
+    :return: list of (name, pharmacies) for each chain of two or more, largest first, where name is
+        the linking value most of the chain shares
+    """
+    pharmacist_names = Counter(pharmacist['Name'] for pharmacist in pharmacists)
+    sets = UnionFind(len(pharmacies))
+    first = {}  # (key, value) -> first pharmacy with it
+    shared_by = Counter()  # (key, value) -> pharmacies with it
+    for i, pharmacy in enumerate(pharmacies):
+        for key in keys:
+            value = pharmacy.get(key)
+            if value is None or key == SUPERINTENDENT and pharmacist_names[value] != 1:
+                continue
+            shared_by[key, value] += 1
+            j = first.setdefault((key, value), i)
+            if j != i:
+                sets.union(i, j)
+    chains = []
+    for group in sets.groups():
+        if len(group) < 2:
+            continue
+        shared = Counter((key, pharmacies[i].get(key)) for i in group for key in keys
+                         if shared_by[key, pharmacies[i].get(key)] > 1)
+        (_, name), _ = max(shared.items(), key=lambda item: (item[1], -keys.index(item[0][0])))
+        chains.append((str(name), [pharmacies[i] for i in group]))
+    chains.sort(key=lambda chain: -len(chain[1]))
+    return chains
+
+
+def write_workbook(chains, file_name='chains.xlsx'):
+    """
+    One worksheet per chain, a row per pharmacy in the pharmacy register's columns
+    :param chains: list of (name, pharmacies) from find_chains
+    :param file_name: name of xlsx file
+    """
+    write_xlsx(((name, 'pharmacy', pharmacies) for name, pharmacies in chains), file_name)
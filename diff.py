@@ -0,0 +1,124 @@
+"""
+Compare two scrapes of a register, e.g. python diff.py data/pharmacy-data-2022-02-28.json data/pharmacy-data-2022-03-01.json
+"""
+import argparse
+import json
+from collections import namedtuple
+
+from colorama import Fore
+
+from snapshots import RegisterSnapshot
+
+FieldChange = namedtuple('FieldChange', ['field', 'before', 'after'])
+RecordChange = namedtuple('RecordChange', ['before', 'after', 'fields'])
+RegisterDiff = namedtuple('RegisterDiff', ['added', 'removed', 'changed'])
+
+KEYS = ('PSI Registration Number', 'Registration Number')  # pharmacies, people
+
+
+def flatten(record, prefix=''):
+    """
+    Flatten nested dicts (e.g. Opening Hours) so each value can be compared on its own
+    :param record: data object
+    :param prefix: path of the enclosing dict
+    :return: dict of field path to value
+    """
+    flat = {}
+    for key, value in record.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{path}.'))
+        else:
+            flat[path] = value
+    return flat
+
+
+def compare_records(before, after, ignore=()):
+    """
+    List the fields that differ between two versions of a record
+    :param before: data object from the older scrape
+    :param after: data object from the newer scrape
+    :param ignore: fields not to report (a nested dict's name ignores all of it)
+    :return: list of FieldChange
+    """
+    if before == after:
+        return []
+    before, after = flatten(before), flatten(after)
+    fields = list(before) + [f for f in after if f not in before]
+    return [FieldChange(f, before.get(f), after.get(f)) for f in fields
+            if f.split('.')[0] not in ignore and f not in ignore and before.get(f) != after.get(f)]
+
+
+def diff_snapshots(old, new, ignore=()):
+    """
+    Compare two snapshots of a register in linear time
+    :param old: RegisterSnapshot of the older scrape
+    :param new: RegisterSnapshot of the newer scrape
+    :param ignore: fields not to report as changed
+    :return: RegisterDiff of added records, removed records and RecordChanges
+    """
+    added = [record for reg, record in new.index.items() if reg not in old.index]
+    removed = [record for reg, record in old.index.items() if reg not in new.index]
+    changed = []
+    for reg, record in new.index.items():
+        previous = old.index.get(reg)
+        if previous is not None:
+            fields = compare_records(previous, record, ignore)
+            if fields:
+                changed.append(RecordChange(previous, record, fields))
+    return RegisterDiff(added, removed, changed)
+
+
+def describe(record, key):
+    """
+    :param record: data object
+    :param key: field holding the registration number
+    :return: one line description of the record
+    """
+    address = record.get('Address')
+    return f"{record[key]}: {record['Name']}" + (f', {address}' if address else '')
+
+
+def print_diff(diff, key):
+    """
+    Print a register diff, one line per record or field
+    :param diff: RegisterDiff
+    :param key: field holding the registration number
+    """
+    for r in diff.removed:
+        print(f'Removed - {describe(r, key)}.')
+    for a in diff.added:
+        print(f'Added - {describe(a, key)}.')
+    for c in diff.changed:
+        for field in c.fields:
+            print(Fore.WHITE + f'Changed - {describe(c.after, key)}. {field.field}: {field.before} -> {field.after}')
+
+
+def guess_key(records):
+    """
+    Work out which register a list of records comes from
+    :param records: data objects
+    :return: field holding the registration number
+    """
+    return next((k for k in KEYS if records and k in records[0]), KEYS[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('old', help='json file of the older scrape')
+    parser.add_argument('new', help='json file of the newer scrape')
+    parser.add_argument('--key', help='field holding the registration number (guessed if not given)')
+    parser.add_argument('--ignore', nargs='*', default=(), help='fields not to report as changed')
+    args = parser.parse_args()
+    with open(args.old) as file:
+        records = json.load(file)
+    key = args.key or guess_key(records)
+    old = RegisterSnapshot(records, key)
+    new = RegisterSnapshot.from_json(args.new, key)
+    diff = diff_snapshots(old, new, args.ignore)
+    print_diff(diff, key)
+    print(Fore.YELLOW + f'{len(diff.added)} added, {len(diff.removed)} removed, {len(diff.changed)} changed')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,101 @@
-from datetime import datetime
+"""
+FOI workbooks from the PSI (e.g. pharmacies with no supervising/superintendent pharmacist) read into json,
+a file per worksheet, and into the register database's foi table, tagged with the workbook's date, e.g.
+python excel_reader.py "Copy of SISV data as at 4th Feb.xlsx" (writes data/foi/No SV.json, No SI.json, ...)
+python excel_reader.py "Copy of SISV data as at 4th Feb.xlsx" --as-of 2022-02-04
+"""
+import argparse
+import os
+from datetime import date, datetime
 
-from openpyxl import load_workbook
+from colorama import Fore
+
+from register_db import DB_FILE, RegisterDB
 from scrape import write_to_json
 
-file_path = 'C:/Users/johnm/Downloads/Copy of SISV data as at 4th Feb.xlsx'
-wb = load_workbook(filename=file_path)
-for sheet in wb:
-    keys = list(sheet.values)[0]
-    obj_list = []
-    for row in sheet.iter_rows(min_row=2, values_only=True):
-        obj = {}
-        for i, r in enumerate(row):
-            try:
-                r = datetime.strftime(r, '%Y-%m-%d')
-            except TypeError:
-                pass
-            obj[keys[i]] = r
-        obj_list.append(obj)
-    json_file = f'{sheet.title}.json'
-    write_to_json(obj_list, json_file)
+FOI_DIR = 'data/foi'
+
+
+def read_sheet(worksheet):
+    """
+    Rows of a worksheet as dicts keyed by its first row; dates (and date-times) become 'YYYY-MM-DD'
+    and empty rows are skipped
+    :param worksheet: openpyxl worksheet (read-only mode streams it)
+    :return: generator of data objects
+    """
+    rows = worksheet.iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None:
+        return
+    for row in rows:
+        if all(value is None for value in row):
+            continue
+        if len(row) < len(header):  # trailing empty cells left off
+            row += (None,) * (len(header) - len(row))
+        yield dict(zip(header, (value.strftime('%Y-%m-%d') if isinstance(value, date) else value
+                                for value in row)))
+
+
+def read_workbook(file_name):
+    """
+    :param file_name: name of xlsx file
+    :return: generator of (worksheet title, list of data objects)
+    """
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_name, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook:
+            yield worksheet.title, list(read_sheet(worksheet))
+    finally:
+        workbook.close()
+
+
+def workbook_date(file_name):
+    """
+    :param file_name: name of xlsx file
+    :return: date (YYYY-MM-DD) the workbook was last saved, as its properties say, else the file's
+    """
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_name, read_only=True)
+    try:
+        saved = workbook.properties.modified or workbook.properties.created
+    finally:
+        workbook.close()
+    return (saved or datetime.fromtimestamp(os.path.getmtime(file_name))).strftime('%Y-%m-%d')
+
+
+def ingest(file_name, output_dir=FOI_DIR, as_of=None, db_file=DB_FILE):
+    """
+    Write each worksheet of an FOI workbook to <output_dir>/<worksheet title>.json, and load it into the
+    register database's foi table
+    :param file_name: name of xlsx file
+    :param output_dir: folder for the json files (created if needed)
+    :param as_of: date of the workbook (YYYY-MM-DD), defaults to workbook_date
+    :param db_file: register database
+    :return: dict of json file written to number of records
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    as_of = as_of or workbook_date(file_name)
+    written = {}
+    with RegisterDB(db_file) as db:
+        for title, records in read_workbook(file_name):
+            json_file = os.path.join(output_dir, f'{title}.json')
+            write_to_json(records, json_file)
+            db.load_foi(title, as_of, records)
+            written[json_file] = len(records)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('workbook', help='xlsx file')
+    parser.add_argument('--output-dir', default=FOI_DIR)
+    parser.add_argument('--as-of', help='date of the workbook (default: when it was last saved)')
+    parser.add_argument('--db', default=DB_FILE)
+    args = parser.parse_args()
+    for json_file, records in ingest(args.workbook, args.output_dir, args.as_of, args.db).items():
+        print(Fore.GREEN + f'{json_file}: {records} records' + Fore.RESET)
+
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Registers written out as spreadsheets, a row at a time (memory stays flat however big the register), e.g.
+python export.py pharmacist --output pharmacists.xlsx (latest scrape in the register database, else in data/)
+python export.py assistant --date 2022-03-01 --output assistants.csv
+python export.py pharmacy --json data/pharmacy-data-2022-03-01.json --output pharmacies.xlsx
+"""
+import argparse
+import csv
+import json
+import re
+
+from colorama import Fore
+
+from register_db import DB_FILE, RegisterDB
+
+SCHEMAS = {  # register -> (header, field) for each column, in order
+    'pharmacy': (
+        ('PSI Registration Number', 'PSI Registration Number'),
+        ('Name', 'Name'),
+        ('Address', 'Address'),
+        ('Tel', 'Tel'),
+        ('Fax', 'Fax'),
+        ('Web', 'Web'),
+        ('Pharmacy Owner', 'Pharmacy Owner'),
+        ('Companies Office Registration No', 'Companies Office Registration No'),
+        ('Superintendent Pharmacist', 'Superintendent Pharmacist'),
+        ('Superintendent Pharmacist Vacant Since', 'Superintendent Pharmacist Vacant Since'),
+        ('Supervising Pharmacist', 'Supervising Pharmacist'),
+        ('Supervising Pharmacist Vacant Since', 'Supervising Pharmacist Vacant Since'),
+        ('Date of First Registration by Current Owner', 'Date of First Registration by Current Owner'),
+        ('Expiry Date of Certificate of Registration', 'Expiry Date of Certificate of Registration'),
+        ('Weekly Hours', ('Opening Hours', 'Weekly Hours')),
+        ('Hospital', 'Hospital'),
+        ('Other', 'Other'),
+    ),
+    'pharmacist': (
+        ('Registration Number', 'Registration Number'),
+        ('Name', 'Name'),
+        ('Address', 'Address'),
+        ('Date Registered', 'Date Registered'),
+        ('Section 77 Registration', 'Section 77 Registration'),
+    ),
+}
+SCHEMAS['assistant'] = SCHEMAS['pharmacist']
+SHEET_TITLE = re.compile(r'[\\/*?:\[\]]')  # characters Excel doesn't allow in a sheet title
+ILLEGAL_CHARACTERS = re.compile(r'[\000-\010]|[\013-\014]|[\016-\037]')  # control characters xlsx can't hold
+
+
+def field(record, name):
+    """
+    :param record: data object
+    :param name: key, or tuple of keys into nested dicts (e.g. ('Opening Hours', 'Weekly Hours'))
+    :return: value, None if the record doesn't have it (keys are matched ignoring their whitespace)
+    """
+    if isinstance(name, tuple):
+        value = record
+        for key in name:
+            value = field(value, key) if isinstance(value, dict) else None
+        return value
+    try:
+        return record[name]
+    except KeyError:
+        return next((v for k, v in record.items() if ' '.join(k.split()) == name), None)
+
+
+def rows(records, register):
+    """
+    :param records: iterable of data objects
+    :param register: assistant, pharmacist or pharmacy
+    :return: generator of the header, then a tuple of values per record, in the register's fixed columns
+    """
+    schema = SCHEMAS[register]
+    yield tuple(header for header, _ in schema)
+    for record in records:
+        yield tuple(field(record, name) for _, name in schema)
+
+
+def sheet_title(name, taken):
+    """
+    :param name: name wanted
+    :param taken: titles already used (lower case, as Excel compares them)
+    :return: a title Excel accepts: allowed characters only, at most 31 long, not already used
+    """
+    base = ' '.join(SHEET_TITLE.sub(' ', name).split()) or 'Sheet'
+    title = base[:31]
+    n = 1
+    while title.lower() in taken:
+        n += 1
+        title = f'{base[:31 - len(str(n)) - 1]} {n}'
+    taken.add(title.lower())
+    return title
+
+
+def write_xlsx(sheets, file_name):
+    """
+    Write a workbook in openpyxl's write-only mode, so rows go to disk as they're added
+    :param sheets: iterable of (title, register, iterable of data objects), a worksheet each
+    :param file_name: name of xlsx file
+    :return: rows written (headers not counted)
+    """
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    taken = set()
+    written = 0
+    for title, register, records in sheets:
+        worksheet = workbook.create_sheet(sheet_title(title, taken))
+        worksheet.freeze_panes = 'A2'
+        for n, values in enumerate(rows(records, register)):
+            worksheet.append([ILLEGAL_CHARACTERS.sub('', v) if isinstance(v, str) else v for v in values])
+            written += n > 0
+    workbook.save(file_name)
+    return written
+
+
+def write_csv(records, register, file_name):
+    """
+    :param records: iterable of data objects
+    :param register: assistant, pharmacist or pharmacy
+    :param file_name: name of csv file
+    :return: rows written (header not counted)
+    """
+    with open(file_name, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        written = -1
+        for values in rows(records, register):
+            writer.writerow(values)
+            written += 1
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('register', choices=sorted(SCHEMAS))
+    parser.add_argument('--output', required=True, help='.xlsx or .csv file')
+    parser.add_argument('--date', help='date of the scrape (default: the latest)')
+    parser.add_argument('--db', default=DB_FILE)
+    parser.add_argument('--json', help='json snapshot to export instead of the database')
+    args = parser.parse_args()
+
+    def write(records, title):
+        if args.output.endswith('.csv'):
+            return write_csv(records, args.register, args.output)
+        return write_xlsx([(title, args.register, records)], args.output)
+
+    if args.json:
+        with open(args.json) as file:
+            written = write(json.load(file), args.register)
+    else:
+        with RegisterDB(args.db) as db:
+            dates = db.dates(args.register)
+            date_ = args.date or (dates[-1] if dates else None)
+            if date_ in dates:
+                written = write(db.iter_records(args.register, date_), f'{args.register} {date_}')
+        if date_ not in dates:  # the scrape wasn't written to sqlite (see scrape.SNAPSHOT_FORMATS)
+            import scrape
+            date_, records = scrape.load_last_scrape(getattr(scrape, args.register), args.date or scrape.today)
+            if args.date and date_ != args.date:
+                raise FileNotFoundError(f'No {args.register} scrape for {args.date} (latest before: {date_})')
+            written = write(records, f'{args.register} {date_}')
+    print(Fore.GREEN + f'{written} {args.register} records written to {args.output}' + Fore.RESET)
+
+
+if __name__ == '__main__':
+    main()
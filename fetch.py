@@ -0,0 +1,285 @@
+import asyncio
+import json
+import random
+import time
+from collections import deque, namedtuple
+
+from aiohttp import (ClientConnectionError, ClientPayloadError, ClientResponseError, ClientSession,
+                     ClientTimeout, TCPConnector)
+from colorama import Fore
+from tqdm import tqdm
+
+# starting point only, the adaptive limiter moves between MIN_IN_FLIGHT and MAX_IN_FLIGHT
+INITIAL_IN_FLIGHT = 20
+MIN_IN_FLIGHT = 2
+MAX_IN_FLIGHT = 100  # requests awaiting a reply at any one time (all hosts)
+MAX_PER_HOST = 50  # open connections to any one host
+KEEPALIVE_TIMEOUT = 30  # seconds an idle connection is kept in the pool
+REQUEST_TIMEOUT = 60  # seconds allowed for a single request
+
+LATENCY_WINDOW = 20  # successful replies per p95 measurement
+LATENCY_TOLERANCE = 0.25  # p95 may drift this far above its best before growth stops
+ADDITIVE_INCREASE = 2
+MULTIPLICATIVE_DECREASE = 0.5
+
+MAX_ATTEMPTS = 4  # per request, including the first
+BACKOFF_BASE = 0.5  # seconds, doubled on each attempt
+BACKOFF_CAP = 30  # seconds
+RETRY_BUDGET_MIN = 10  # retries always allowed per run
+RETRY_BUDGET_RATIO = 0.02  # plus this share of requests sent
+
+# errors that mean the website is struggling (5xx replies are raised as ClientResponseError)
+OVERLOAD_ERRORS = (ClientResponseError, ClientPayloadError, asyncio.TimeoutError)
+# errors worth trying again, a dropped connection doesn't say anything about load
+RETRYABLE_ERRORS = OVERLOAD_ERRORS + (ClientConnectionError,)
+
+Reply = namedtuple('Reply', ['status', 'headers', 'text'])
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile
+    :param values: sample of numbers
+    :param p: percentile wanted (0-100)
+    :return: value at that percentile
+    """
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """
+    Exponential backoff with full jitter, so retries don't arrive together
+    :param attempt: number of attempts already failed (1 or more)
+    :param base: delay before the first retry (before jitter)
+    :param cap: longest delay allowed
+    :return: seconds to wait
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit: grows while p95 latency stays flat, halves on errors
+    """
+
+    def __init__(self, initial=INITIAL_IN_FLIGHT, minimum=MIN_IN_FLIGHT, maximum=MAX_IN_FLIGHT,
+                 window=LATENCY_WINDOW, tolerance=LATENCY_TOLERANCE,
+                 increase=ADDITIVE_INCREASE, decrease=MULTIPLICATIVE_DECREASE):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(maximum, initial))
+        self.window = window
+        self.tolerance = tolerance
+        self.increase = increase
+        self.decrease = decrease
+        self.in_flight = 0
+        self.baseline = None  # best p95 seen so far
+        self.decisions = []  # (time, old limit, new limit, reason)
+        self._latencies = []
+        self._completed = 0
+        self._last_cut = None
+        self._waiters = deque()
+
+    async def acquire(self):
+        """
+        Wait until a request slot is free under the current limit
+        """
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():  # slot was handed over, give it back
+                self.in_flight -= 1
+                self._wake()
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self, latency, error=None):
+        """
+        Free a request slot and feed the outcome into the controller
+        :param latency: seconds the request took (None if it failed for an unrelated reason)
+        :param error: overload error raised by the request, if any
+        """
+        self.in_flight -= 1
+        self._completed += 1
+        if error is not None:
+            self._on_error(error)
+        elif latency is not None:
+            self._latencies.append(latency)
+            if len(self._latencies) >= self.window:
+                self._on_window()
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def _on_error(self, error):
+        # only cut once per round of requests, the ones already in flight fail together
+        if self._last_cut is not None and self._completed - self._last_cut < self.limit:
+            return
+        self._last_cut = self._completed
+        self._latencies = []
+        self._set_limit(int(self.limit * self.decrease), f'{type(error).__name__}')
+
+    def _on_window(self):
+        p95 = percentile(self._latencies, 95)
+        self._latencies = []
+        if self.baseline is None or p95 < self.baseline:
+            self.baseline = p95
+        if p95 <= self.baseline * (1 + self.tolerance):
+            self._set_limit(self.limit + self.increase, f'p95 {p95:.2f}s flat')
+        else:
+            self._log(self.limit, self.limit, f'p95 {p95:.2f}s rising (best {self.baseline:.2f}s), holding')
+
+    def _set_limit(self, new_limit, reason):
+        new_limit = max(self.minimum, min(self.maximum, new_limit))
+        if new_limit != self.limit:
+            self._log(self.limit, new_limit, reason)
+            self.limit = new_limit
+
+    def _log(self, old, new, reason):
+        self.decisions.append((time.time(), old, new, reason))
+        colour = Fore.RED if new < old else Fore.BLUE
+        tqdm.write(colour + f'Concurrency {old} -> {new}: {reason}' + Fore.RESET)
+
+
+def load_limit(file_name, default=INITIAL_IN_FLIGHT):
+    """
+    Load the concurrency limit reached by the last run
+    :param file_name: state file written by save_limit
+    :param default: value to use if there is no saved state
+    :return: concurrency limit (as int)
+    """
+    try:
+        with open(file_name) as file:
+            return json.load(file)['limit']
+    except (FileNotFoundError, KeyError, ValueError):
+        return default
+
+
+def save_limit(file_name, limiter):
+    """
+    Save the concurrency limit reached, so the next run starts from it
+    :param file_name: state file
+    :param limiter: adaptive limiter used in this run
+    """
+    with open(file_name, 'w') as file:
+        json.dump({'limit': limiter.limit, 'baseline p95': limiter.baseline}, file, indent=2)
+
+
+class FetchEngine:
+    """
+    One connection pool and one adaptive concurrency limit, shared by every request of a run
+    """
+
+    def __init__(self, initial_in_flight=INITIAL_IN_FLIGHT, max_in_flight=MAX_IN_FLIGHT,
+                 max_per_host=MAX_PER_HOST, keepalive_timeout=KEEPALIVE_TIMEOUT,
+                 request_timeout=REQUEST_TIMEOUT, max_attempts=MAX_ATTEMPTS, state_file=None, metrics=None):
+        self.max_in_flight = max_in_flight
+        self.max_per_host = max_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.state_file = state_file
+        if state_file is not None:
+            initial_in_flight = load_limit(state_file, initial_in_flight)
+        self.limiter = AdaptiveLimiter(initial=initial_in_flight, maximum=max_in_flight)
+        self.max_attempts = max_attempts
+        self.requests = 0
+        self.retries = 0
+        self.bytes = 0
+        self.metrics = metrics  # RunMetrics to record request latency, bytes and retries in
+        self.session = None
+
+    async def __aenter__(self):
+        connector = TCPConnector(limit=self.max_in_flight,
+                                 limit_per_host=self.max_per_host,
+                                 keepalive_timeout=self.keepalive_timeout)
+        self.session = ClientSession(connector=connector,
+                                     timeout=ClientTimeout(total=self.request_timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.session = None
+        if self.state_file is not None:
+            save_limit(self.state_file, self.limiter)
+
+    def retry_allowed(self):
+        """
+        Check the run's retry budget (a fixed allowance plus a share of requests sent)
+        :return: True if another retry may be sent
+        """
+        return self.retries < RETRY_BUDGET_MIN + RETRY_BUDGET_RATIO * self.requests
+
+    async def get_text(self, url, params=None):
+        """
+        Send a GET request through the shared pool, retrying with backoff while the retry budget allows
+        :param url: URL to fetch
+        :param params: query string parameters
+        :return: html reply
+        """
+        return (await self.get_reply(url, params)).text
+
+    async def get_reply(self, url, params=None, headers=None):
+        """
+        As get_text, for callers that need the status and headers too (e.g. conditional requests)
+        :param url: URL to fetch
+        :param params: query string parameters
+        :param headers: extra request headers
+        :return: Reply (status, headers, text)
+        """
+        attempt = 1
+        while True:
+            try:
+                return await self._get_once(url, params, headers)
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_attempts or not self.retry_allowed():
+                    raise
+                delay = backoff_delay(attempt)
+                tqdm.write(Fore.YELLOW + f'{type(e).__name__} ({params}), retry {attempt} in {delay:.1f}s'
+                           + Fore.RESET)
+                self.retries += 1
+                if self.metrics is not None:
+                    self.metrics.count(f'retries.{type(e).__name__}')
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _get_once(self, url, params, headers):
+        await self.limiter.acquire()
+        self.requests += 1
+        if self.metrics is not None:
+            self.metrics.count('requests')
+        start = time.perf_counter()
+        latency = error = None
+        try:
+            async with self.session.get(url, params=params, headers=headers) as reply:
+                if reply.status >= 500:
+                    reply.raise_for_status()
+                body = await reply.read()
+                result = Reply(reply.status, reply.headers, await reply.text())
+            latency = time.perf_counter() - start
+            self.bytes += len(body)
+            if self.metrics is not None:
+                self.metrics.observe('request latency', latency)
+                self.metrics.count('bytes downloaded', len(body))
+                if reply.status == 304:
+                    self.metrics.count('not modified')
+            return result
+        except OVERLOAD_ERRORS as e:
+            error = e
+            if self.metrics is not None:
+                self.metrics.count(f'errors.{type(e).__name__}')
+            raise
+        finally:
+            self.limiter.release(latency, error)
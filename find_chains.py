@@ -1,82 +1,38 @@
-import json
-import csv
-from collections import Counter
-from scrape import today
-from openpyxl import Workbook
+"""
+Group the pharmacies of a scrape into chains and write them to chains.xlsx, a sheet per chain, e.g.
+python find_chains.py --date 2022-03-01 (the latest scrapes on or before that date, from json or the history)
+"""
+import argparse
+
+from colorama import Fore
+
+import scrape
+from chains import find_chains, write_workbook
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--date', default=scrape.today, help='date of the scrape (default: today)')
+    parser.add_argument('--output', default='chains.xlsx')
+    args = parser.parse_args()
+    pharmacy_date, pharmacies = scrape.load_last_scrape(scrape.pharmacy, args.date)
+    pharmacist_date, pharmacists = scrape.load_last_scrape(scrape.pharmacist, args.date)
+    print(Fore.WHITE + f'Pharmacies scraped {pharmacy_date}, pharmacists {pharmacist_date}' + Fore.RESET)
+    chains = find_chains(pharmacies, pharmacists)
+    in_chains = sum(len(chain) for _, chain in chains)
+    for name, chain in chains:
+        print(f'{name} ({len(chain)})')
+        for pharmacy in chain:
+            print(f"    {pharmacy['Name']}, {pharmacy['Address']}")
+    print(f'{len(chains)} chains, {in_chains} pharmacies in chains, {len(pharmacies) - in_chains} independent,'
+          f' {len(pharmacies)} in all')
+    write_workbook(chains, args.output)
+
 
-last_scrape_date = today
+if __name__ == '__main__':
+    main()
 
-workbook = Workbook()
 
-with open(f'data/pharmacy-data-{last_scrape_date}.json') as file:
-    pharmacies = json.load(file)
-with open(f'data/pharmacist-data-{last_scrape_date}.json') as file:
-    pharmacists = json.load(file)
-names = [pharmacy['Name'] for pharmacy in pharmacies]
-print(Counter(names).most_common())
-allcare = [name for name in names if 'Allcare' in name]
-for a in allcare:
-    print(a)
-exit()
-chains = []
-for k in ('Companies Office Registration No', 'Pharmacy Owner', 'Superintendent Pharmacist'):
-    x = [ph[k] for ph in pharmacies]
-    for match, count in Counter(x).most_common():
-        chain = [ph for ph in pharmacies if ph[k] == match]
-        dup = 1
-        if k == 'Superintendent Pharmacist':
-            dup = len([ph for ph in pharmacists if ph['Name'] == match])
-        if match is not None and count > 1 and dup == 1:
-            worksheet = workbook.create_sheet(str(match))
-            for c in chain:
-                chains.append(c)
-                pharmacies.remove(c)
-                del c['Opening Hours']
-                worksheet.append(tuple(c.values()))
-                print(f"{c['Name']}, {c['Address']}")
-print(len(pharmacies), len(chains), len(chains) + len(pharmacies))
-for n, pharmacy in enumerate(pharmacies, start=1):
-    print(n, f"{pharmacy['Name']}, {pharmacy['Address']}")
-print(len(pharmacies), len(chains), len(chains) + len(pharmacies))
-workbook.save('chains.xlsx')
-exit()
-chains = set()
-independents = set()
-for k in ('Companies Office Registration No', 'Pharmacy Owner', 'Superintendent Pharmacist', 'Web'):
-    x = [ph[k] for ph in pharmacies]
-    print(x)
-    for match, count in Counter(x).most_common():
-        print(match, count)
-        exit()
-        if match is not None and count > 1:
-            chain = [ph for ph in pharmacies if ph[k] == match]
-            if k == 'Superintendent Pharmacist':
-                dup = len([ph for ph in pharmacists if ph['Name'] == match])
-                if dup == 0:
-                    for p in chain:
-                        chains.add(f"{p['PSI Registration Number']}: {p['Name']}, {p['Address']}")
-                    print(k)
-                    print(match)
-                    print([f"{p['PSI Registration Number']}: {p['Name']}" for p in chain])
-                    print(len(chain))
-            else:
-                for p in chain:
-                    chains.add(f"{p['PSI Registration Number']}: {p['Name']}, {p['Address']}")
-                print(k)
-                print(match)
-                print([f"{p['PSI Registration Number']}: {p['Name']}" for p in chain])
-                print(len(chain))
-        else:
-            independent = [ph for ph in pharmacies if ph[k] == match]
-            for ph in independent:
-                independents.add(f"{ph['PSI Registration Number']}: {ph['Name']}, {ph['Address']}")
-for c in chains:
-    print(c)
-print(len(chains))
-for c in independents:
-    print(c)
-print(len(independents))
-exit()
 """
 Allcare Uniphar Cormac Loughnane
 Lloyd's Hilton Health Express
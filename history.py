@@ -0,0 +1,303 @@
+"""
+Register history kept as a base snapshot plus one delta per day, e.g.
+python history.py build pharmacy (import the existing data/pharmacy-data-*.json snapshots)
+python history.py build pharmacy --prune (then delete the ones the history rebuilds, bar the latest)
+python history.py show pharmacy 7441 (every change to one record)
+"""
+import argparse
+import json
+import os
+from bisect import bisect_right
+
+from colorama import Fore
+
+from snapshots import RegisterSnapshot, SnapshotCatalog
+
+REBASE_EVERY = 30  # deltas before a new full base is written, bounds the work to rebuild a date
+HISTORY_DIR = 'history'
+
+
+def dump(data, file_name):
+    """
+    Write compact json (history files are read by code, not people)
+    :param data: data to write
+    :param file_name: name of json file
+    """
+    with open(file_name, 'w') as file:
+        json.dump(data, file, separators=(',', ':'))
+
+
+def load(file_name):
+    """
+    :param file_name: name of json file
+    :return: data in file
+    """
+    with open(file_name) as file:
+        return json.load(file)
+
+
+def patch(before, after):
+    """
+    Field-level changes turning one version of a record into another
+    :param before: data object from the older scrape
+    :param after: data object from the newer scrape
+    :return: (fields set, fields removed), or None if patching wouldn't reproduce the key order
+    """
+    set_ = {k: v for k, v in after.items() if k not in before or before[k] != v}
+    unset = [k for k in before if k not in after]
+    patched = dict(before)
+    for k in unset:
+        del patched[k]
+    patched.update(set_)
+    if list(patched) != list(after):
+        return None
+    return set_, unset
+
+
+def make_delta(old, new, date_):
+    """
+    Changes from one day's register to the next
+    :param old: RegisterSnapshot of the older scrape
+    :param new: RegisterSnapshot of the newer scrape
+    :param date_: date of the newer scrape
+    :return: delta (dict)
+    """
+    delta = {'date': date_, 'added': [], 'removed': [], 'updated': [], 'replaced': []}
+    for reg, record in new.index.items():
+        previous = old.index.get(reg)
+        if previous is None:
+            delta['added'].append(record)
+        elif previous != record or list(previous) != list(record):
+            changes = patch(previous, record)
+            if changes is None:
+                delta['replaced'].append(record)
+            else:
+                delta['updated'].append([reg, *changes])
+    delta['removed'] = [reg for reg in old.index if reg not in new.index]
+    order = [r[new.key] for r in new.records]
+    if order != expected_order(old, delta, new.key):
+        delta['order'] = order
+    return delta
+
+
+def expected_order(old, delta, key):
+    """
+    Order of records after a delta, if it doesn't say otherwise: survivors in their old order, then additions
+    :param old: RegisterSnapshot the delta applies to
+    :param delta: delta (dict)
+    :param key: field holding the registration number
+    :return: list of registration numbers
+    """
+    removed = set(delta['removed'])
+    return [reg for reg in old.index if reg not in removed] + [r[key] for r in delta['added']]
+
+
+def apply_delta(old, delta):
+    """
+    :param old: RegisterSnapshot the delta applies to
+    :param delta: delta (dict)
+    :return: RegisterSnapshot after the delta
+    """
+    key = old.key
+    records = dict(old.index)
+    for reg in delta['removed']:
+        del records[reg]
+    for reg, set_, unset in delta['updated']:
+        record = dict(records[reg])
+        for k in unset:
+            del record[k]
+        record.update(set_)
+        records[reg] = record
+    for record in delta['added'] + delta['replaced']:
+        records[record[key]] = record
+    order = delta.get('order') or expected_order(old, delta, key)
+    return RegisterSnapshot([records[reg] for reg in order], key)
+
+
+def touched(delta, key):
+    """
+    :param delta: delta (dict)
+    :param key: field holding the registration number
+    :return: registration numbers added, removed or changed by the delta
+    """
+    return ([r[key] for r in delta['added'] + delta['replaced']] + delta['removed']
+            + [reg for reg, _, _ in delta['updated']])
+
+
+class HistoryStore:
+    """
+    Day-by-day history of one register: full bases every REBASE_EVERY days, deltas in between,
+    and an index of the days each record changed on
+    """
+
+    def __init__(self, root, key, rebase_every=REBASE_EVERY):
+        """
+        :param root: folder for this register's history (created on the first append)
+        :param key: field holding the registration number
+        :param rebase_every: deltas before a new base is written
+        """
+        self.root = root
+        self.key = key
+        self.rebase_every = rebase_every
+        self.index_file = os.path.join(root, 'index.json')
+        try:
+            self.index = load(self.index_file)
+        except FileNotFoundError:
+            self.index = {'bases': [], 'deltas': [], 'records': {}}
+
+    def dates(self):
+        """
+        :return: every date held, in order
+        """
+        return sorted(self.index['bases'] + self.index['deltas'])
+
+    def _file(self, kind, date_):
+        return os.path.join(self.root, f'{kind}-{date_}.json')
+
+    def rebuild(self, date_):
+        """
+        The full register as it was on a date
+        :param date_: date (YYYY-MM-DD), the latest day held on or before it is used
+        :return: RegisterSnapshot
+        """
+        bases = self.index['bases']
+        i = bisect_right(bases, date_)
+        if i == 0:
+            raise FileNotFoundError(f'No history in {self.root} on or before {date_}')
+        base = bases[i - 1]
+        snapshot = RegisterSnapshot(load(self._file('base', base)), self.key)
+        for delta_date in self.index['deltas']:
+            if base < delta_date <= date_:
+                snapshot = apply_delta(snapshot, load(self._file('delta', delta_date)))
+        return snapshot
+
+    def append(self, date_, records):
+        """
+        Add a day's scrape: a delta against the latest day held, or a new base when one is due
+        :param date_: date of the scrape (YYYY-MM-DD), later than any held
+        :param records: list of data objects
+        """
+        dates = self.dates()
+        if dates and date_ <= dates[-1]:
+            raise ValueError(f'{date_} is not after the latest day held ({dates[-1]})')
+        os.makedirs(self.root, exist_ok=True)
+        new = RegisterSnapshot(records, self.key)
+        bases = self.index['bases']
+        deltas_since_base = len([d for d in self.index['deltas'] if bases and d > bases[-1]])
+        duplicates = len(new.index) != len(records)  # a delta can't hold two records with one number
+        if not bases or deltas_since_base >= self.rebase_every or duplicates:
+            dump(records, self._file('base', date_))
+            bases.append(date_)
+            changed = new.index
+            if dates:
+                changed = touched(make_delta(self.rebuild(dates[-1]), new, date_), self.key)
+        else:
+            delta = make_delta(self.rebuild(dates[-1]), new, date_)
+            dump(delta, self._file('delta', date_))
+            self.index['deltas'].append(date_)
+            changed = touched(delta, self.key)
+        for reg in changed:
+            self.index['records'].setdefault(str(reg), []).append(date_)
+        dump(self.index, self.index_file)
+
+    def record_history(self, registration_number):
+        """
+        Every version of one record, reading only the days it changed on
+        :param registration_number: registration number
+        :return: list of (date, data object, or None once removed)
+        """
+        changes = self.index['records'].get(str(registration_number), [])
+        history = []
+        record = None
+        for date_ in changes:
+            if date_ in self.index['deltas']:
+                delta = load(self._file('delta', date_))
+                if registration_number in delta['removed']:
+                    record = None
+                else:
+                    added = {r[self.key]: r for r in delta['added'] + delta['replaced']}
+                    if registration_number in added:
+                        record = added[registration_number]
+                    else:
+                        _, set_, unset = next(u for u in delta['updated'] if u[0] == registration_number)
+                        record = dict(record)
+                        for k in unset:
+                            del record[k]
+                        record.update(set_)
+            else:  # a base (the record's first day, or a change that fell on a rebase)
+                record = RegisterSnapshot(load(self._file('base', date_)), self.key).get(registration_number)
+            history.append((date_, record))
+        return history
+
+
+def history_store(data_dir, register, key):
+    """
+    :param data_dir: data folder
+    :param register: assistant, pharmacist or pharmacy
+    :param key: field holding the registration number
+    :return: HistoryStore for the register
+    """
+    return HistoryStore(os.path.join(data_dir, HISTORY_DIR, register), key)
+
+
+def prune(catalog, store, register):
+    """
+    Delete json snapshots (and their msgpack copies) the history rebuilds exactly, keeping the latest
+    :param catalog: SnapshotCatalog of the data folder
+    :param store: HistoryStore of the register
+    :param register: assistant, pharmacist or pharmacy
+    """
+    held = set(store.dates())
+    entries = catalog.in_range(register, '0000-00-00', '9999-99-99')[:-1]
+    for entry in entries:
+        if entry['date'] not in held:
+            continue
+        file_name = catalog.path(entry)
+        if store.rebuild(entry['date']).records != load(file_name):
+            print(Fore.LIGHTRED_EX + f"{entry['file']} differs from the history, kept" + Fore.RESET)
+            continue
+        for stale in (file_name, f'{file_name[:-len(".json")]}.msgpack'):
+            if os.path.exists(stale):
+                os.remove(stale)
+        print(f"{entry['file']} removed")
+    catalog.refresh()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-dir', default='data')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='add catalogued json snapshots not yet in the history')
+    build.add_argument('register', choices=('assistant', 'pharmacist', 'pharmacy'))
+    build.add_argument('--prune', action='store_true', help='delete json snapshots held in the history, bar the latest')
+    show = commands.add_parser('show', help='every change to one record')
+    show.add_argument('register', choices=('assistant', 'pharmacist', 'pharmacy'))
+    show.add_argument('registration_number', type=int)
+    args = parser.parse_args()
+    key = 'PSI Registration Number' if args.register == 'pharmacy' else 'Registration Number'
+    store = history_store(args.data_dir, args.register, key)
+    if args.command == 'build':
+        held = store.dates()
+        catalog = SnapshotCatalog(args.data_dir)
+        for entry in catalog.in_range(args.register, '0000-00-00', '9999-99-99'):
+            if not held or entry['date'] > held[-1]:
+                store.append(entry['date'], load(os.path.join(args.data_dir, entry['file'])))
+                print(f"{entry['date']}: {entry['records']} records")
+        if args.prune:
+            prune(catalog, store, args.register)
+    elif args.command == 'show':
+        previous = None
+        for date_, record in store.record_history(args.registration_number):
+            if record is None:
+                print(Fore.RED + f'{date_}: removed' + Fore.RESET)
+            elif previous is None:
+                print(Fore.GREEN + f"{date_}: {record['Name']}, {record.get('Address')}" + Fore.RESET)
+            else:
+                for field in sorted(set(previous) | set(record)):
+                    if previous.get(field) != record.get(field):
+                        print(f'{date_}: {field}: {previous.get(field)} -> {record.get(field)}')
+            previous = record
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Per-stage timings, counters and histograms for a scrape run, written out as a json report
+"""
+import json
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from fetch import percentile
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # seconds, upper bounds
+
+
+def peak_rss_mb():
+    """
+    :return: peak resident memory of this process so far (MB), or None where it can't be read (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KB elsewhere
+
+
+def summarise(values):
+    """
+    :param values: timings (seconds)
+    :return: count, total, mean, p50, p95 and max (as dict)
+    """
+    if not values:
+        return {'count': 0}
+    return {'count': len(values), 'total': sum(values), 'mean': sum(values) / len(values),
+            'p50': percentile(values, 50), 'p95': percentile(values, 95), 'max': max(values)}
+
+
+def histogram(values, buckets=LATENCY_BUCKETS):
+    """
+    :param values: sample of numbers
+    :param buckets: upper bounds of the buckets, in order
+    :return: dict of '<=bound' (and '>last bound') to count
+    """
+    counts = Counter()
+    for value in values:
+        counts[next((f'<={b}' for b in buckets if value <= b), f'>{buckets[-1]}')] += 1
+    return {label: counts[label] for label in [f'<={b}' for b in buckets] + [f'>{buckets[-1]}'] if counts[label]}
+
+
+class RunMetrics:
+    """
+    Timings of each stage of a run (e.g. 'pharmacy.parse'), counters, histograms and peak memory,
+    with an optional profiler wrapped around chosen stages
+    """
+
+    def __init__(self, profile=(), profiler='cProfile'):
+        """
+        :param profile: stages to profile (every call of a stage goes into one profile)
+        :param profiler: 'cProfile' or 'pyinstrument' (needs pyinstrument)
+        """
+        self.started = time.time()
+        self.timings = {}  # stage -> list of seconds
+        self.counters = Counter()
+        self.samples = {}  # histogram name -> list of values
+        self.gauges = {}
+        self.profile = set(profile)
+        self.profiler = profiler
+        self.profiles = {}  # stage -> profiler
+        self._profiling = None  # stage the profiler is running for
+        self._profile_depth = 0  # calls of that stage still running
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a block of code as one call of a stage (profiled if the stage was asked for),
+        e.g. with metrics.stage('pharmacy.diff'): ...
+        :param name: stage name
+        """
+        profiling = name in self.profile and self._start_profile(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.setdefault(name, []).append(time.perf_counter() - start)
+            if profiling:
+                self._stop_profile()
+
+    def _start_profile(self, name):
+        """
+        Only one profiler can run at a time, so it runs from the first entry of a stage to the last exit of
+        the calls that overlap it (an async stage's profile takes in whatever else the loop ran meanwhile).
+        Profiled stages entered while another one is being profiled aren't, and are counted instead
+        :param name: stage name
+        :return: True if the stage is being profiled
+        """
+        if self._profiling is None:
+            profiler = self._profiler(name)
+            if self.profiler == 'cProfile':
+                profiler.enable()
+            else:
+                profiler.start()
+            self._profiling = name
+        elif self._profiling != name:
+            self.counters[f'{name}.not profiled (inside {self._profiling})'] += 1
+            return False
+        self._profile_depth += 1
+        return True
+
+    def _stop_profile(self):
+        self._profile_depth -= 1
+        if self._profile_depth == 0:
+            profiler = self.profiles[self._profiling]
+            if self.profiler == 'cProfile':
+                profiler.disable()
+            else:
+                profiler.stop()
+            self._profiling = None
+
+    def _profiler(self, name):
+        if name not in self.profiles:
+            if self.profiler == 'cProfile':
+                import cProfile
+                self.profiles[name] = cProfile.Profile()
+            else:
+                from pyinstrument import Profiler
+                self.profiles[name] = Profiler(async_mode='disabled')
+        return self.profiles[name]
+
+    def profiled(self, name):
+        """
+        :param name: stage name
+        :return: True if the stage is being profiled
+        """
+        return name in self.profile
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def observe(self, name, value):
+        """
+        Add a value to a histogram
+        :param name: histogram name
+        :param value: value (e.g. seconds)
+        """
+        self.samples.setdefault(name, []).append(value)
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def report(self):
+        """
+        :return: the run's measurements (as dict, ready for json)
+        """
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'seconds': time.time() - self.started,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': {name: summarise(values) for name, values in sorted(self.timings.items())},
+            'counters': dict(sorted(self.counters.items())),
+            'gauges': dict(sorted(self.gauges.items())),
+            'histograms': {name: dict(summarise(values), buckets=histogram(values))
+                           for name, values in sorted(self.samples.items())},
+        }
+
+    def write(self, file_name):
+        """
+        Write the report, and each stage profile next to it (<report>-<stage>.prof or .html)
+        :param file_name: name of json file
+        :return: names of the profile files written
+        """
+        with open(file_name, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+        written = []
+        for name, profiler in self.profiles.items():
+            base = f'{file_name[:-len(".json")]}-{name}'
+            if self.profiler == 'cProfile':
+                profiler.dump_stats(f'{base}.prof')
+                written.append(f'{base}.prof')
+            else:
+                with open(f'{base}.html', 'w') as file:
+                    file.write(profiler.output_html())
+                written.append(f'{base}.html')
+        return written
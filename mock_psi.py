@@ -0,0 +1,219 @@
+"""
+Local stand-in for registrations.thepsi.ie, serving register pages built from snapshots or the saved fixture, e.g.
+python mock_psi.py --records 2000 --latency 0.05 --jitter 0.05 --error-rate 0.01
+python mock_psi.py --snapshot pharmacy=data/pharmacy-data-2022-03-01.json
+then point scrape.BASE_URL at http://127.0.0.1:8765/search-register/
+"""
+import argparse
+import asyncio
+import html
+import json
+import os
+import random
+
+from aiohttp import web
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scratch.html')
+PAGE_SIZE = 9
+TYPES = {'pharmacy': 0, 'pharmacist': 1, 'assistant': 2}
+DAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday', 'Bank Holidays')
+NOT_RENDERED = ('Name', 'Address', 'County', 'Hospital', 'Other', 'Section 77 Registration',
+                'Supervising Pharmacist Vacant Since', 'Superintendent Pharmacist Vacant Since')
+
+
+def page_template():
+    """
+    The fixture split around its result items, so served pages carry the live site's markup around the records
+    :return: html before the first result item, html after the last
+    """
+    with open(FIXTURE, encoding='utf-8') as file:
+        page = file.read()
+    first_item = page.rfind('<div', 0, page.index('search-register-result-item'))
+    end_of_items = page.rfind('</div>', 0, page.index('<!-- Pagination -->'))
+    return page[:first_item], page[end_of_items:]
+
+
+def render_value(value):
+    """
+    Inverse of scrape.value_converter
+    :param value: value from a data object
+    :return: text as the register shows it
+    """
+    if value is None:
+        return 'N/A'
+    if value is True:
+        return 'Yes'
+    if value is False:
+        return 'No'
+    return html.escape(str(value))
+
+
+def render_opening_hours(opening_hours):
+    """
+    Inverse of scrape.get_opening_hours
+    :param opening_hours: dict of day to times (Hours Open and Weekly Hours are worked out again by the parser)
+    :return: html of the opening hours
+    """
+    lines = []
+    for day in DAYS:
+        times = opening_hours.get(day)
+        if times is None:
+            continue
+        if times['Open'] is None:
+            lines.append(f'{day}: Closed')
+        elif 'Lunch Closure' in times:
+            lines.append(f"{day}: {times['Open']} to {times['Lunch Closure']}, "
+                         f"{times['Lunch Reopen']} to {times['Closed']}")
+        else:
+            lines.append(f"{day}: {times['Open']} to {times['Closed']}")
+    return ''.join(f'<br/>{line}\n' for line in lines) + '<br/>'
+
+
+def render_item(record):
+    """
+    One result item, in the markup the scraper reads
+    :param record: data object
+    :return: html of the item
+    """
+    name = html.escape(record['Name'])
+    if record.get('Section 77 Registration'):
+        name += ' - Section 77 Registration'
+    address = html.escape(record.get('Address') or '')
+    if 'Section 77 Registration' in record:  # people: address inside a comment (pre 12/1/22)
+        address = f'<!-- <small>{address}</small> -->'
+    else:
+        address = f'<small>{address}</small>'
+    labels = []
+    for key, value in record.items():
+        if key in NOT_RENDERED:
+            continue
+        if key == 'Opening Hours':
+            value = render_opening_hours(value)
+        else:
+            value = render_value(value)
+        labels.append(f'<p class="srchlbls">{html.escape(key)}: <span class="srchitms">{value}</span></p>')
+    return (f'<div class="col-lg-4 col-md-6 col-sm-6 search-register-result-item"><div class="card">'
+            f'<div class="card-header"><div class="avatar-content"><h5>{name}</h5>{address}</div></div>'
+            f'<div class="card-body">{"".join(labels)}</div></div></div>\n')
+
+
+def render_pages(records, template=None):
+    """
+    A register as the pages the website would serve
+    :param records: list of data objects
+    :param template: (before, after) from page_template
+    :return: list of html pages (page 1 first)
+    """
+    before, after = template or page_template()
+    count = f'<span class="terms">{len(records)}</span>'
+    before = before.replace('<span class="terms">1980</span>', count, 1)
+    last = max(1, -(-len(records) // PAGE_SIZE))
+    pages = []
+    for page in range(1, last + 1):
+        items = ''.join(render_item(r) for r in records[(page - 1) * PAGE_SIZE:page * PAGE_SIZE])
+        description = f'<p class="pagination-description">Page {page} of {last} </p>'
+        pages.append(before + items + after.replace('<p class="pagination-description">Page 6 of 220 </p>',
+                                                    description, 1))
+    return pages
+
+
+def synthetic_records(register, records):
+    """
+    A register of distinct records built from the fixture, for when no snapshot is to hand
+    :param register: assistant, pharmacist or pharmacy
+    :param records: number of records wanted
+    :return: list of data objects
+    """
+    import scrape
+    with open(FIXTURE, encoding='utf-8') as file:
+        fixture = [{' '.join(k.split()): v for k, v in r.items()} for r in scrape.extract_page(file.read())]
+    synthetic = []
+    for n in range(records):
+        pharmacy_ = fixture[n % len(fixture)]
+        if register == 'pharmacy':
+            record = json.loads(json.dumps(pharmacy_))
+            record['Name'] = f"{record['Name']} {n}"
+            record['PSI Registration Number'] = 10000 + n
+        else:
+            record = {'Name': f"{pharmacy_['Supervising Pharmacist'] or 'Vacant'} {n}",
+                      'Address': pharmacy_['Address'],
+                      'Registration Number': 10000 + n,
+                      'Date Registered': f'{1 + n % 28:02d}/{1 + n % 12:02d}/{1980 + n % 40}',
+                      'Section 77 Registration': n % 50 == 0}
+        synthetic.append(record)
+    return synthetic
+
+
+class MockRegister:
+    """
+    The register search pages for each register type, served with configurable latency, jitter and errors
+    """
+
+    def __init__(self, pages, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        """
+        :param pages: dict of register type (0, 1, 2) to list of html pages
+        :param latency: seconds added to every reply
+        :param jitter: up to this many seconds more, at random
+        :param error_rate: share of requests answered 503
+        :param seed: random seed, for repeatable runs
+        """
+        self.pages = pages
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.stats = {'requests': 0, 'errors': 0, 'bytes': 0}
+
+    async def search_register(self, request):
+        self.stats['requests'] += 1
+        await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+        if self.random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return web.Response(status=503, text='Service Unavailable')
+        pages = self.pages.get(int(request.query.get('type', 0)))
+        if pages is None:
+            raise web.HTTPNotFound()
+        page = int(request.query.get('page', 1))
+        body = pages[min(page, len(pages)) - 1]  # past the end the live site repeats its last page
+        self.stats['bytes'] += len(body.encode())
+        return web.Response(text=body, content_type='text/html')
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/search-register/', self.search_register)
+        app.router.add_get('/stats', self.get_stats)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--snapshot', action='append', default=[], metavar='REGISTER=FILE',
+                        help='serve a register from a json snapshot (registers not given are synthetic)')
+    parser.add_argument('--records', type=int, default=2000, help='records in each synthetic register')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    snapshots = dict(s.split('=', 1) for s in args.snapshot)
+    template = page_template()
+    pages = {}
+    for register, type_ in TYPES.items():
+        if register in snapshots:
+            with open(snapshots[register]) as file:
+                records = json.load(file)
+        else:
+            records = synthetic_records(register, args.records)
+        pages[type_] = render_pages(records, template)
+    mock = MockRegister(pages, args.latency, args.jitter, args.error_rate, args.seed)
+    print(f'Serving {", ".join(f"{r} ({len(pages[t])} pages)" for r, t in TYPES.items())} on port {args.port}',
+          flush=True)
+    web.run_app(mock.app(), port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Hours open worked out from "HH:MM" times, one day at a time
+"""
+import re
+from functools import lru_cache
+
+HH_MM = re.compile(r'(2[0-3]|[0-1]\d|\d):([0-5]\d|\d)')  # what strptime accepts for '%H:%M'
+NOON = 12 * 60
+TEN_AM = 10 * 60
+
+
+@lru_cache(maxsize=None)  # a few hundred distinct times across the whole register
+def minutes(time_string):
+    """
+    Parse a time as strptime(time_string, '%H:%M') would, to minutes past midnight
+    :param time_string: e.g. '09:00'
+    :return: minutes past midnight (as int)
+    """
+    if not isinstance(time_string, str):
+        raise TypeError(f'time must be str, not {type(time_string).__name__}')
+    match = HH_MM.fullmatch(time_string)
+    if match is None:
+        raise ValueError(f'time data {time_string!r} does not match format HH:MM')
+    return int(match[1]) * 60 + int(match[2])
+
+
+def day_hours(day, times):
+    """
+    Hours open on one day: closing times that must be pm (before opening, or 10:00) are moved on 12 hours,
+    and a lunch closure is taken off (Bank Holidays count only their lunch, as they always have)
+    :param day: day name
+    :param times: dict of Open, Closed and, if it closes for lunch, Lunch Closure and Lunch Reopen
+    :return: hours open (0 if closed)
+    """
+    hours_open = 0
+    try:
+        open_ = minutes(times['Open'])
+        closed = minutes(times['Closed'])
+        if open_ > closed > 0 or closed == TEN_AM:
+            closed += NOON
+        hours = (closed - open_) / 60
+        hours %= 24
+        if day != 'Bank Holidays':
+            hours_open += hours
+        try:
+            lunch1 = minutes(times['Lunch Closure'])
+            lunch2 = minutes(times['Lunch Reopen'])
+            hours = (lunch2 - lunch1) / 60
+            if hours > 0:  # ignore incorrect (negative) lunch hours
+                hours %= 24
+                hours_open -= hours
+        except KeyError:  # no lunch
+            pass
+    except TypeError:  # no entry (closed)
+        pass
+    return hours_open
+
@@ -0,0 +1,195 @@
+"""
+Compact register records: one __slots__ object per entry instead of a dict, repeated strings interned,
+and opening hours shared between pharmacies that keep the same hours. Each converts to and from the
+data objects written to the JSON snapshots without loss (same keys, key order, values and types)
+"""
+import json
+import sys
+from collections.abc import Mapping
+
+_layouts = {}  # tuple of keys -> tuple of (key, attribute or None), shared by records with the same keys
+_hours = {}  # repr of opening hours -> the one frozen copy
+
+
+def normalise(key):
+    """
+    :param key: key as scraped (labels can hold newlines and tabs)
+    :return: key with its whitespace collapsed, e.g. 'PSI Registration Number'
+    """
+    return ' '.join(key.split())
+
+
+def freeze_hours(opening_hours):
+    """
+    :param opening_hours: dict of day to times (and Weekly Hours), as get_opening_hours gives
+    :return: the same as nested tuples, shared with any other pharmacy keeping the same hours
+    """
+    frozen = tuple((day, tuple(times.items()) if isinstance(times, dict) else times)
+                   for day, times in opening_hours.items())
+    return _hours.setdefault(repr(frozen), frozen)  # repr, so 0 and 0.0 aren't taken for each other
+
+
+def thaw_hours(frozen):
+    """
+    :param frozen: opening hours from freeze_hours
+    :return: dict of day to times (a new copy)
+    """
+    return {day: dict(times) if isinstance(times, tuple) else times for day, times in frozen}
+
+
+class Record(Mapping):
+    """
+    A register entry with a slot for each field the register shows; fields it doesn't know (the website
+    adds one now and then) are kept in a dict. Built once from a data object and read like one,
+    e.g. record['Name'], record.get('Address'), dict(record), or by attribute, e.g. record.name
+    """
+    __slots__ = ('_layout', '_extra')
+    FIELDS = {}  # key (normalised) -> attribute
+    INTERNED = frozenset()  # attributes with few distinct values
+
+    def _set_layout(self, keys):
+        keys = tuple(keys)
+        layout = _layouts.get(keys)
+        if layout is None:
+            layout = _layouts[keys] = tuple((key, self.FIELDS.get(normalise(key))) for key in keys)
+        self._layout = layout
+
+    def _has(self, attribute):
+        try:
+            object.__getattribute__(self, attribute)
+        except AttributeError:
+            return False
+        return True
+
+    def _store(self, attribute, value):
+        if attribute == 'opening_hours' and isinstance(value, dict):
+            value = freeze_hours(value)
+        elif attribute in self.INTERNED and type(value) is str:
+            value = sys.intern(value)
+        object.__setattr__(self, attribute, value)
+
+    @classmethod
+    def from_dict(cls, data_object):
+        """
+        :param data_object: record as scraped or loaded from a JSON snapshot
+        :return: record
+        """
+        record = cls.__new__(cls)
+        record._set_layout(data_object)
+        record._extra = None
+        for (key, attribute), value in zip(record._layout, data_object.values()):
+            if attribute is None or record._has(attribute):  # unknown, or the field's second spelling
+                if record._extra is None:
+                    record._extra = {}
+                record._extra[key] = value
+            else:
+                record._store(attribute, value)
+        return record
+
+    def _value(self, key, attribute):
+        if attribute is None or key in (self._extra or ()):
+            return self._extra[key]
+        value = object.__getattribute__(self, attribute)
+        return thaw_hours(value) if attribute == 'opening_hours' else value
+
+    def to_dict(self):
+        """
+        :return: the data object this record was built from (a new dict, keys in their original order)
+        """
+        return {key: self._value(key, attribute) for key, attribute in self._layout}
+
+    def __getitem__(self, key):
+        for key_, attribute in self._layout:
+            if key_ == key:
+                return self._value(key_, attribute)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return (key for key, _ in self._layout)
+
+    def __len__(self):
+        return len(self._layout)
+
+    def __getattr__(self, attribute):  # only called for fields this record doesn't have
+        if attribute in self.FIELDS.values():
+            return None
+        raise AttributeError(f'{type(self).__name__!r} object has no attribute {attribute!r}')
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+
+class Pharmacy(Record):
+    FIELDS = {
+        'Name': 'name',
+        'Address': 'address',
+        'Tel': 'tel',
+        'Fax': 'fax',
+        'Web': 'web',
+        'Superintendent Pharmacist': 'superintendent',
+        'Supervising Pharmacist': 'supervising',
+        'Pharmacy Owner': 'owner',
+        'PSI Registration Number': 'registration_number',
+        'Date of First Registration by Current Owner': 'date_registered',
+        'Expiry Date of Certificate of Registration': 'expiry_date',
+        'Companies Office Registration No': 'company_number',
+        'Opening Hours': 'opening_hours',
+        'Hospital': 'hospital',
+        'Other': 'other',
+        'Supervising Pharmacist Vacant Since': 'supervising_vacant_since',
+        'Superintendent Pharmacist Vacant Since': 'superintendent_vacant_since',
+    }
+    INTERNED = frozenset({'superintendent', 'supervising', 'owner', 'date_registered', 'expiry_date',
+                          'supervising_vacant_since', 'superintendent_vacant_since'})
+    __slots__ = tuple(FIELDS.values())
+
+
+class Person(Record):
+    FIELDS = {
+        'Name': 'name',
+        'Address': 'address',
+        'Registration Number': 'registration_number',
+        'Date Registered': 'date_registered',
+        'Section 77 Registration': 'section_77',
+    }
+    INTERNED = frozenset({'address', 'date_registered'})  # addresses are towns, mostly
+    __slots__ = tuple(FIELDS.values())
+
+
+class Pharmacist(Person):
+    __slots__ = ()
+
+
+class Assistant(Person):
+    __slots__ = ()
+
+
+RECORD_TYPES = {'pharmacy': Pharmacy, 'pharmacist': Pharmacist, 'assistant': Assistant}
+
+
+def from_dicts(data, record_type):
+    """
+    :param data: list of data objects
+    :param record_type: Pharmacy, Pharmacist or Assistant
+    :return: list of records
+    """
+    return [record_type.from_dict(data_object) for data_object in data]
+
+
+def to_dicts(records):
+    """
+    :param records: list of records
+    :return: list of data objects, ready for json
+    """
+    return [record.to_dict() for record in records]
+
+
+def load(file_name, record_type):
+    """
+    Load a JSON snapshot as records
+    :param file_name: name of json file
+    :param record_type: Pharmacy, Pharmacist or Assistant
+    :return: list of records
+    """
+    with open(file_name) as file:
+        return from_dicts(json.load(file), record_type)
@@ -0,0 +1,310 @@
+"""
+The registers in a local SQLite database, one row per record per scrape, e.g.
+python register_db.py load (add catalogued json snapshots not yet in the database)
+python register_db.py query "SELECT owner, COUNT(*) FROM records WHERE register = 'pharmacy' GROUP BY owner"
+The PSI's FOI replies (see excel_reader.py) are kept alongside, in the foi table, by sheet and workbook date
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+
+from colorama import Fore
+
+DB_NAME = 'register.sqlite'  # in the data folder
+DB_FILE = os.path.join('data', DB_NAME)
+COLUMNS = {  # column -> field in the data object
+    'registration_number': ('PSI Registration Number', 'Registration Number'),
+    'name': ('Name',),
+    'address': ('Address',),
+    'county': ('County',),
+    'owner': ('Pharmacy Owner',),
+    'superintendent': ('Superintendent Pharmacist',),
+    'supervising': ('Supervising Pharmacist',),
+    'superintendent_vacant_since': ('Superintendent Pharmacist Vacant Since',),
+    'supervising_vacant_since': ('Supervising Pharmacist Vacant Since',),
+}
+FOI_COLUMNS = {  # column -> field in an FOI row
+    'registration_number': ('Reg',),
+    'date_removed': ('Date removed',),
+}
+INDEXED = ('registration_number', 'owner', 'superintendent', 'supervising', 'county',
+           'superintendent_vacant_since', 'supervising_vacant_since')
+COUNTY = re.compile(r'(Co\. \w+|Dublin \d+\w?)\s*$')
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS records (
+    register TEXT NOT NULL,
+    scrape_date TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    {', '.join(f'{column} {"INTEGER" if column == "registration_number" else "TEXT"}' for column in COLUMNS)},
+    data TEXT NOT NULL,
+    PRIMARY KEY (register, scrape_date, position)
+);
+{''.join(f"""
+CREATE INDEX IF NOT EXISTS records_{column} ON records (register, scrape_date, {column});"""
+         for column in INDEXED)}
+CREATE INDEX IF NOT EXISTS records_history ON records (register, registration_number, scrape_date);
+
+CREATE TABLE IF NOT EXISTS foi (
+    sheet TEXT NOT NULL,
+    as_of TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    registration_number INTEGER,
+    date_removed TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (sheet, as_of, position)
+);
+CREATE INDEX IF NOT EXISTS foi_registration_number ON foi (sheet, as_of, registration_number);
+'''
+
+
+def county_of(record):
+    """
+    County of a record: the County field (people, pre 12/1/22) or the end of the address, e.g. 'Co. Wicklow'
+    :param record: data object
+    :return: county, or None if it can't be told
+    """
+    if record.get('County'):
+        return record['County']
+    match = COUNTY.search(record.get('Address') or '')
+    return match[1] if match else None
+
+
+def row(register, date_, position, record):
+    """
+    :param register: assistant, pharmacist or pharmacy
+    :param date_: date of the scrape (YYYY-MM-DD)
+    :param position: place of the record in the scrape
+    :param record: data object
+    :return: tuple of column values
+    """
+    values = [register, date_, position]
+    for column, fields in COLUMNS.items():
+        if column == 'county':
+            values.append(county_of(record))
+        else:
+            values.append(next((record[f] for f in fields if f in record), None))
+    values.append(json.dumps(record))
+    return tuple(values)
+
+
+def foi_row(sheet, as_of, position, foi_record):
+    """
+    :param sheet: worksheet title of the FOI reply
+    :param as_of: date of the workbook (YYYY-MM-DD)
+    :param position: place of the row in the worksheet
+    :param foi_record: data object
+    :return: tuple of column values
+    """
+    values = [sheet, as_of, position]
+    for fields in FOI_COLUMNS.values():
+        values.append(next((foi_record[f] for f in fields if f in foi_record), None))
+    values.append(json.dumps(foi_record))
+    return tuple(values)
+
+
+class RegisterDB:
+    """
+    Scrapes of the registers in SQLite, indexed for the questions the analysis scripts ask
+    (by registration number, owner, superintendent, supervising pharmacist, county and vacancy dates)
+    """
+
+    def __init__(self, file_name=DB_FILE):
+        """
+        :param file_name: database file (created if needed)
+        """
+        self.connection = sqlite3.connect(file_name)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def load(self, register, date_, records):
+        """
+        Load a scrape, replacing any already loaded for that register and date
+        :param register: assistant, pharmacist or pharmacy
+        :param date_: date of the scrape (YYYY-MM-DD)
+        :param records: list of data objects
+        """
+        with self.connection:
+            self.connection.execute('DELETE FROM records WHERE register = ? AND scrape_date = ?', (register, date_))
+            self.connection.executemany(
+                f'INSERT INTO records VALUES ({", ".join("?" * (len(COLUMNS) + 4))})',
+                (row(register, date_, position, record) for position, record in enumerate(records)))
+
+    def load_foi(self, sheet, as_of, rows):
+        """
+        Load a worksheet of an FOI reply, replacing any already loaded for that sheet and date
+        :param sheet: worksheet title, e.g. 'No SV'
+        :param as_of: date of the workbook (YYYY-MM-DD)
+        :param rows: list of data objects, as read_sheet gives
+        """
+        with self.connection:
+            self.connection.execute('DELETE FROM foi WHERE sheet = ? AND as_of = ?', (sheet, as_of))
+            self.connection.executemany(
+                f'INSERT INTO foi VALUES ({", ".join("?" * (len(FOI_COLUMNS) + 4))})',
+                (foi_row(sheet, as_of, position, r) for position, r in enumerate(rows)))
+
+    def foi(self, sheet, as_of=None):
+        """
+        :param sheet: worksheet title, e.g. 'No SV'
+        :param as_of: date of the workbook (YYYY-MM-DD), defaults to the latest loaded
+        :return: list of data objects, in sheet order (empty if the sheet was never loaded)
+        """
+        if as_of is None:
+            as_of = self.connection.execute('SELECT MAX(as_of) FROM foi WHERE sheet = ?', (sheet,)).fetchone()[0]
+        return [json.loads(r['data']) for r in self.query(
+            'SELECT data FROM foi WHERE sheet = ? AND as_of = ? ORDER BY position', (sheet, as_of))]
+
+    def dates(self, register):
+        """
+        :param register: assistant, pharmacist or pharmacy
+        :return: dates loaded, in order
+        """
+        return [r[0] for r in self.connection.execute(
+            'SELECT DISTINCT scrape_date FROM records WHERE register = ? ORDER BY scrape_date', (register,))]
+
+    def latest_date(self, register):
+        """
+        :param register: assistant, pharmacist or pharmacy
+        :return: date of the latest scrape loaded
+        """
+        date_ = self.connection.execute(
+            'SELECT MAX(scrape_date) FROM records WHERE register = ?', (register,)).fetchone()[0]
+        if date_ is None:
+            raise LookupError(f'No {register} scrape in the database')
+        return date_
+
+    def query(self, sql, params=()):
+        """
+        Run any query against the records table
+        :param sql: SQL
+        :param params: query parameters
+        :return: list of sqlite3.Row
+        """
+        return self.connection.execute(sql, params).fetchall()
+
+    def find(self, register, date_=None, **criteria):
+        """
+        Records matching every criterion, e.g. find('pharmacy', owner='Boots Retail (Ireland) Limited')
+        :param register: assistant, pharmacist or pharmacy
+        :param date_: date of the scrape (YYYY-MM-DD), defaults to the latest loaded
+        :param criteria: column=value, None matches NULL (e.g. supervising=None for vacancies)
+        :return: list of data objects, in scrape order
+        """
+        where, params = ['register = ?', 'scrape_date = ?'], [register, date_ or self.latest_date(register)]
+        for column, value in criteria.items():
+            if column not in COLUMNS:
+                raise ValueError(f'{column} is not a column of the register database')
+            if value is None:
+                where.append(f'{column} IS NULL')
+            else:
+                where.append(f'{column} = ?')
+                params.append(value)
+        return [json.loads(r['data']) for r in self.query(
+            f'SELECT data FROM records WHERE {" AND ".join(where)} ORDER BY position', params)]
+
+    def iter_records(self, register, date_=None):
+        """
+        Every record of a scrape, read from the database a batch at a time (for exporting whole registers)
+        :param register: assistant, pharmacist or pharmacy
+        :param date_: date of the scrape (YYYY-MM-DD), defaults to the latest loaded
+        :return: generator of data objects, in scrape order
+        """
+        cursor = self.connection.execute(
+            'SELECT data FROM records WHERE register = ? AND scrape_date = ? ORDER BY position',
+            (register, date_ or self.latest_date(register)))
+        while True:
+            batch = cursor.fetchmany(1000)
+            if not batch:
+                return
+            for r in batch:
+                yield json.loads(r['data'])
+
+    def get(self, register, registration_number, date_=None):
+        """
+        :param register: assistant, pharmacist or pharmacy
+        :param registration_number: registration number
+        :param date_: date of the scrape (YYYY-MM-DD), defaults to the latest loaded
+        :return: data object, or None if it isn't on the register
+        """
+        records = self.find(register, date_, registration_number=registration_number)
+        return records[0] if records else None
+
+    def vacancies(self, role, since=None, date_=None):
+        """
+        Pharmacies without a supervising or superintendent pharmacist, longest vacant first
+        :param role: 'supervising' or 'superintendent'
+        :param since: only vacancies from this date (YYYY-MM-DD) on
+        :param date_: date of the scrape (YYYY-MM-DD), defaults to the latest loaded
+        :return: list of data objects
+        """
+        column = f'{role.lower()}_vacant_since'
+        if column not in COLUMNS:
+            raise ValueError(f'{role} is not supervising or superintendent')
+        return [json.loads(r['data']) for r in self.query(
+            f'SELECT data FROM records WHERE register = ? AND scrape_date = ? AND {column} >= ?'
+            f' ORDER BY {column}, position', ('pharmacy', date_ or self.latest_date('pharmacy'), since or ''))]
+
+    def count_by(self, register, column, date_=None):
+        """
+        Records per value of a column, e.g. count_by('pharmacy', 'owner') for the largest chains
+        :param register: assistant, pharmacist or pharmacy
+        :param column: column to group by
+        :param date_: date of the scrape (YYYY-MM-DD), defaults to the latest loaded
+        :return: list of (value, count), largest first
+        """
+        if column not in COLUMNS:
+            raise ValueError(f'{column} is not a column of the register database')
+        return [tuple(r) for r in self.query(
+            f'SELECT {column}, COUNT(*) AS n FROM records WHERE register = ? AND scrape_date = ?'
+            f' GROUP BY {column} ORDER BY n DESC, {column}', (register, date_ or self.latest_date(register)))]
+
+    def history(self, register, registration_number):
+        """
+        :param register: assistant, pharmacist or pharmacy
+        :param registration_number: registration number
+        :return: list of (date, data object) for each scrape loaded with the record on it
+        """
+        return [(r['scrape_date'], json.loads(r['data'])) for r in self.query(
+            'SELECT scrape_date, data FROM records WHERE register = ? AND registration_number = ?'
+            ' ORDER BY scrape_date, position', (register, registration_number))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=DB_FILE)
+    commands = parser.add_subparsers(dest='command', required=True)
+    load = commands.add_parser('load', help='add catalogued json snapshots not yet in the database')
+    load.add_argument('--data-dir', default='data')
+    query = commands.add_parser('query', help='run a query and print the rows')
+    query.add_argument('sql')
+    args = parser.parse_args()
+    with RegisterDB(args.db) as db:
+        if args.command == 'load':
+            from snapshots import SnapshotCatalog
+            catalog = SnapshotCatalog(args.data_dir)
+            for entry in sorted(catalog.entries.values(), key=lambda e: (e['type'], e['date'])):
+                if entry['date'] not in db.dates(entry['type']):
+                    with open(catalog.path(entry)) as file:
+                        db.load(entry['type'], entry['date'], json.load(file))
+                    print(f"{entry['file']}: {entry['records']} records")
+        elif args.command == 'query':
+            rows = db.query(args.sql)
+            if rows:
+                print(Fore.YELLOW + ' | '.join(rows[0].keys()) + Fore.RESET)
+            for r in rows:
+                print(' | '.join(str(value) for value in r))
+
+
+if __name__ == '__main__':
+    main()
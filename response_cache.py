@@ -0,0 +1,222 @@
+"""
+Raw register pages kept on disk, so parser and analysis changes can be re-run without the website.
+Bodies are stored once per distinct content (by sha256, gzipped) and indexed by (type, page, date)
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import time
+import uuid
+from bisect import bisect_right, insort
+from collections import Counter
+from datetime import date, timedelta
+
+CACHE_NAME = 'cache'  # in the data folder
+CACHE_DIR = os.path.join('data', CACHE_NAME)
+COMPRESS_LEVEL = 1  # gzip level of the bodies: a third bigger than at 9, for a third of the CPU
+MAX_BYTES = 1 << 30  # compressed bodies kept, oldest dropped first beyond this
+MAX_AGE_DAYS = 90  # days a scrape's pages are kept
+
+
+class CacheMiss(LookupError):
+    """
+    A page asked for in replay mode isn't in the cache
+    """
+
+
+class ResponseCache:
+    """
+    Content-addressed store of register pages, with the ETag/Last-Modified each was served with
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR):
+        """
+        :param cache_dir: folder for the index and bodies (created on the first store)
+        """
+        self.cache_dir = cache_dir
+        self.index_file = os.path.join(cache_dir, 'index.json')
+        try:
+            with open(self.index_file) as file:
+                self.entries = json.load(file)  # 'type/page/date' -> entry
+        except FileNotFoundError:
+            self.entries = {}
+        self._index()
+        self.hits = self.misses = self.not_modified = 0
+
+    @staticmethod
+    def key(type_, page, date_):
+        return f'{type_}/{page}/{date_}'
+
+    def _index(self):
+        self._dates = {}  # 'type/page' -> sorted dates cached
+        for k in self.entries:
+            self._dates.setdefault(k.rsplit('/', 1)[0], []).append(k.rsplit('/', 1)[1])
+        for dates in self._dates.values():
+            dates.sort()
+
+    def _add(self, type_, page, date_, entry):
+        k = self.key(type_, page, date_)
+        if k not in self.entries:
+            insort(self._dates.setdefault(f'{type_}/{page}', []), date_)
+        self.entries[k] = entry
+
+    def _blob(self, sha256):
+        return os.path.join(self.cache_dir, 'blobs', sha256[:2], f'{sha256}.html.gz')
+
+    def read(self, entry):
+        """
+        :param entry: index entry
+        :return: html of the page
+        """
+        with gzip.open(self._blob(entry['sha256']), 'rt', encoding='utf-8') as file:
+            return file.read()
+
+    def _write(self, html):
+        """
+        Write a body unless that content is stored already (safe to run in threads, the index isn't touched)
+        :param html: html of the page
+        :return: (sha256, compressed size)
+        """
+        sha256 = hashlib.sha256(html.encode()).hexdigest()
+        blob = self._blob(sha256)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            temp = f'{blob}.{uuid.uuid4().hex}.tmp'  # two threads can be writing the same content
+            with gzip.open(temp, 'wt', encoding='utf-8', compresslevel=COMPRESS_LEVEL) as file:
+                file.write(html)
+            os.replace(temp, blob)
+        return sha256, os.path.getsize(blob)
+
+    def _entry(self, type_, page, date_, sha256, size, headers):
+        headers = headers or {}
+        entry = {'sha256': sha256, 'size': size, 'stored': time.time(),
+                 'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+        self._add(type_, page, date_, entry)
+        return entry
+
+    def store(self, type_, page, date_, html, headers=None):
+        """
+        Add a page, writing its body only if that content isn't stored already
+        :param type_: register type (0 pharmacy, 1 pharmacist, 2 assistant)
+        :param page: page number
+        :param date_: date of the scrape (YYYY-MM-DD)
+        :param html: html of the page
+        :param headers: reply headers (ETag and Last-Modified are kept)
+        :return: index entry
+        """
+        return self._entry(type_, page, date_, *self._write(html), headers)
+
+    def latest(self, type_, page, date_=None):
+        """
+        Most recent copy of a page, on or before a date
+        :param type_: register type
+        :param page: page number
+        :param date_: date (YYYY-MM-DD), None for any
+        :return: (date, index entry), or (None, None) if the page isn't cached
+        """
+        dates = self._dates.get(f'{type_}/{page}', [])
+        i = len(dates) if date_ is None else bisect_right(dates, date_)
+        if i == 0:
+            return None, None
+        return dates[i - 1], self.entries[self.key(type_, page, dates[i - 1])]
+
+    async def fetch(self, engine, url, params, type_, page, date_, refresh=False):
+        """
+        Get a page through the cache: a copy already stored for the date, or a conditional request
+        (If-None-Match/If-Modified-Since against the latest copy) whose 304 reuses that copy
+        :param engine: open fetch engine
+        :param url: URL of the register
+        :param params: query string parameters
+        :param type_: register type
+        :param page: page number
+        :param date_: date of the scrape (YYYY-MM-DD)
+        :param refresh: always request the page in full (a re-fetch: the copy held may be what was wrong)
+        :return: html of the page
+        """
+        loop = asyncio.get_running_loop()  # compressing and decompressing run in its default executor
+        entry = self.entries.get(self.key(type_, page, date_))
+        if entry is not None and not refresh:
+            self.hits += 1
+            return await loop.run_in_executor(None, self.read, entry)
+        _, previous = self.latest(type_, page, date_) if not refresh else (None, None)
+        headers = {}
+        if previous is not None and previous['etag']:
+            headers['If-None-Match'] = previous['etag']
+        if previous is not None and previous['last_modified']:
+            headers['If-Modified-Since'] = previous['last_modified']
+        reply = await engine.get_reply(url, params, headers or None)
+        if reply.status == 304 and previous is not None:
+            self.not_modified += 1
+            self._add(type_, page, date_, dict(previous, stored=time.time()))
+            return await loop.run_in_executor(None, self.read, previous)
+        self.misses += 1
+        sha256, size = await loop.run_in_executor(None, self._write, reply.text)
+        self._entry(type_, page, date_, sha256, size, reply.headers)
+        return reply.text
+
+    def discard(self, type_, page, date_):
+        """
+        Forget the copy of a page stored for a date (e.g. it came back with records missing),
+        its body is deleted by the next evict if nothing else refers to it
+        :param type_: register type
+        :param page: page number
+        :param date_: date of the scrape (YYYY-MM-DD)
+        """
+        if self.entries.pop(self.key(type_, page, date_), None) is not None:
+            self._dates[f'{type_}/{page}'].remove(date_)
+
+    def replay(self, type_, page, date_):
+        """
+        A page as it was fetched on or before a date, without touching the network
+        :param type_: register type
+        :param page: page number
+        :param date_: date (YYYY-MM-DD)
+        :return: html of the page
+        """
+        _, entry = self.latest(type_, page, date_)
+        if entry is None:
+            raise CacheMiss(f'page {page} of register type {type_} is not cached on or before {date_}')
+        self.hits += 1
+        return self.read(entry)
+
+    def evict(self, max_bytes=MAX_BYTES, max_age_days=MAX_AGE_DAYS, today=None):
+        """
+        Drop pages older than max_age_days, then the oldest scrapes until the bodies fit in max_bytes,
+        and delete bodies nothing refers to any more
+        :param max_bytes: compressed bytes of bodies to keep at most
+        :param max_age_days: days to keep pages for
+        :param today: date to count age from (YYYY-MM-DD), defaults to today
+        :return: number of entries dropped
+        """
+        cutoff = str(date.fromisoformat(today or str(date.today())) - timedelta(days=max_age_days))
+        before = len(self.entries)
+        self.entries = {k: e for k, e in self.entries.items() if k.rsplit('/', 1)[1] >= cutoff}
+        refs = Counter(e['sha256'] for e in self.entries.values())
+        sizes = {e['sha256']: e['size'] for e in self.entries.values()}
+        total = sum(sizes.values())
+        for k in sorted(self.entries, key=lambda k: (k.rsplit('/', 1)[1], self.entries[k]['stored'])):
+            if total <= max_bytes:
+                break
+            sha256 = self.entries.pop(k)['sha256']
+            refs[sha256] -= 1
+            if not refs[sha256]:
+                total -= sizes[sha256]
+        self._index()
+        referenced = {e['sha256'] for e in self.entries.values()}
+        blobs_dir = os.path.join(self.cache_dir, 'blobs')
+        for root, _, files in os.walk(blobs_dir):
+            for name in files:
+                if name.split('.')[0] not in referenced:
+                    os.remove(os.path.join(root, name))
+        return before - len(self.entries)
+
+    def save(self):
+        """
+        Write the index
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(f'{self.index_file}.tmp', 'w') as file:
+            json.dump(self.entries, file)
+        os.replace(f'{self.index_file}.tmp', self.index_file)
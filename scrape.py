@@ -1,87 +1,206 @@
+import argparse
 import asyncio
+import hashlib
 import json
-import math
+import os
 import time
-from datetime import date, datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, timedelta
 from itertools import chain
 
 import bs4
-from aiohttp import ClientSession, ClientPayloadError
 from colorama import Fore
+from lxml import etree
 from tqdm import tqdm
 
+from diff import diff_snapshots, print_diff
+from fetch import RETRYABLE_ERRORS, FetchEngine
+from history import history_store, prune
+from metrics import RunMetrics, peak_rss_mb
+from opening_hours import day_hours
+from records import RECORD_TYPES, from_dicts, to_dicts
+from register_db import DB_NAME, RegisterDB
+from response_cache import CACHE_NAME, CacheMiss, ResponseCache
+from snapshots import RegisterSnapshot, SnapshotCatalog
+
 BASE_URL = 'https://registrations.thepsi.ie/search-register/'
+DATA_DIR = 'data'  # every file below is kept in here
+SNAPSHOT_FORMATS = ('history',)  # 'history': daily delta (see history.py), with the latest day also as json and
+# older json pruned once the history rebuilds it; opt-in: 'json': a full json copy kept for every day, 'sqlite': rows
+# in the register database (see register_db.py), 'msgpack': binary copy alongside the json
 PARSER = 'lxml'
+RATE_LIMIT_FILE = 'fetch-state.json'  # concurrency reached by the last run, next run starts there
+PARSE_QUEUE_SIZE = 20  # pages being fetched or waiting to be parsed, bounds the raw html held in memory
+PARSE_WORKERS = 0  # worker processes for parsing, 0 parses in a thread of this process
+PARSE_ENGINE = 'xpath'  # 'xpath' (lxml only, fast) or 'bs4' (full BeautifulSoup tree), same output
+INCREMENTAL = True  # reuse the last scrape's records for pages whose content hasn't changed
+CACHE_RESPONSES = False  # keep raw pages in DATA_DIR/cache (see response_cache.py) to replay, scrape.py --cache
+REPLAY = None  # date (YYYY-MM-DD) to re-run from cached pages only, writing to DATA_DIR/replay (scrape.py --replay)
+PROFILE_STAGES = ()  # stages to profile, e.g. ('pharmacy.parse',) (python scrape.py --profile pharmacy.parse)
+PROFILER = 'cProfile'  # or 'pyinstrument' (needs pyinstrument)
+PAGE_SIZE = 9  # records on every page of the register but the last
+SHORT_PAGE_RETRIES = 2  # re-fetches of a page with fewer records than it should have
+COMPACT_RECORDS = False  # hold last scrapes as records.Record objects (see records.py), not dicts
+PAGE_HASHES_FILE = 'page-hashes.json'  # content hash + registration numbers of each page, per register
 
 today = str(date.today())
 start_global = time.perf_counter()
 
-semaphore_pause = 1000
-
 
 class DataType:
-    def __init__(self, type_, json_):
+    def __init__(self, type_, json_, key):
         self.type = type_
         self.json = f'{json_}-data'
+        self.key = key  # field holding the registration number
+        self.pages = None  # pages on the register, read from page 1 of each crawl
+        self.records = None  # records on the register, as page 1 reports it
 
     def __str__(self):
         return self.json[:-5]
 
 
-assistant = DataType(2, 'assistant')
-pharmacist = DataType(1, 'pharmacist')
-pharmacy = DataType(0, 'pharmacy')
+assistant = DataType(2, 'assistant', 'Registration Number')
+pharmacist = DataType(1, 'pharmacist', 'Registration Number')
+pharmacy = DataType(0, 'pharmacy', 'PSI Registration Number')
+
+
+_catalog = None
+_response_cache = None
+_metrics = None
+
+
+def data_path(name):
+    """
+    :param name: file or folder name
+    :return: its path in DATA_DIR (read when called, so DATA_DIR can be changed at runtime)
+    """
+    return os.path.join(DATA_DIR, name)
+
+
+def snapshot_catalog():
+    """
+    Catalogue of the snapshots in the data folder (scanned once, on first use)
+    :return: SnapshotCatalog
+    """
+    global _catalog
+    if _catalog is None or _catalog.data_dir != DATA_DIR:
+        _catalog = SnapshotCatalog(DATA_DIR)
+    return _catalog
+
+
+def response_cache():
+    """
+    Cache of raw register pages (index loaded once, on first use)
+    :return: ResponseCache
+    """
+    global _response_cache
+    if _response_cache is None or _response_cache.cache_dir != data_path(CACHE_NAME):
+        _response_cache = ResponseCache(data_path(CACHE_NAME))
+    return _response_cache
 
 
-def load_last_scrape(data_type):
+def run_metrics():
+    """
+    Measurements of the current run (a new RunMetrics each run, see get_all_data)
+    :return: RunMetrics
+    """
+    global _metrics
+    if _metrics is None:
+        _metrics = RunMetrics(PROFILE_STAGES, PROFILER)
+    return _metrics
+
+
+def load_last_scrape(data_type, as_of=None):
     """
     Load data from last scrape
     :param data_type: assistant, pharmacist or pharmacy
-    :return: data from last scrape
+    :param as_of: date (YYYY-MM-DD) to load the latest scrape on or before, defaults to the day before
+        this scrape's (the replayed date's, in replay mode)
+    :return: date of the scrape (YYYY-MM-DD), data from it
     """
-    data = None
-    i = 1
-    while not data:
-        last_scrape_date = str(date.today() - timedelta(days=i))
-        try:
-            with open(f'data/{data_type.json}-{last_scrape_date}.json') as file:
-                data = json.load(file)
-        except FileNotFoundError:
-            i += 1
-    return data
+    if as_of is None:
+        as_of = str(date.fromisoformat(REPLAY or today) - timedelta(days=1))
+    catalog = snapshot_catalog()
+    history = history_store(DATA_DIR, str(data_type), data_type.key)
+    held = [d for d in history.dates() if d <= as_of]
+    try:
+        entry = catalog.as_of(str(data_type), as_of)
+    except FileNotFoundError:
+        if not held:
+            raise
+        entry = None
+    if entry is None or held and held[-1] > entry['date']:  # json pruned, or only history written
+        return held[-1], history.rebuild(as_of).records
+    file_name = catalog.path(entry)
+    packed_file_name = f'{file_name[:-len(".json")]}.msgpack'
+    if os.path.exists(packed_file_name) and os.path.getmtime(packed_file_name) >= os.path.getmtime(file_name):
+        from binary_snapshots import read_msgpack  # same data, quicker to load (unless the json was rewritten)
+        return entry['date'], read_msgpack(packed_file_name)
+    with open(file_name) as file:
+        return entry['date'], json.load(file)
+
+
+_last_snapshots = {}  # loaded on first use, so importing this module stays cheap
+LAST_SCRAPES = {'assistants': assistant, 'pharmacists': pharmacist, 'pharmacies': pharmacy}
+
+
+def last_snapshot(data_type):
+    """
+    Last scrape of a register, indexed by registration number (loaded once, on first use)
+    :param data_type: assistant, pharmacist or pharmacy
+    :return: RegisterSnapshot (of records.Record objects if COMPACT_RECORDS)
+    """
+    if data_type.json not in _last_snapshots:
+        date_, data = load_last_scrape(data_type)
+        if COMPACT_RECORDS:
+            data = from_dicts(data, RECORD_TYPES[str(data_type)])
+        _last_snapshots[data_type.json] = RegisterSnapshot(data, data_type.key, date_)
+    return _last_snapshots[data_type.json]
 
 
-def pages_plus_two_percent(data_list):
+def last_scrape(data_type):
     """
-    Add 2% to number of pages of register on last scrape (to allow for an increase)
-    :param data_list: data from last scrape
-    :return: pages + 2% (as int)
+    Data from the last scrape of a register (loaded once, on first use)
+    :param data_type: assistant, pharmacist or pharmacy
+    :return: list of data objects
     """
-    return int((math.ceil(len(data_list)) / 9) * 1.02) + 1
+    return last_snapshot(data_type).records
 
 
-assistants = load_last_scrape(assistant)
-assistant.pages = pages_plus_two_percent(assistants)
-pharmacists = load_last_scrape(pharmacist)
-pharmacist.pages = pages_plus_two_percent(pharmacists)
-pharmacies = load_last_scrape(pharmacy)
-pharmacy.pages = pages_plus_two_percent(pharmacies)
+def __getattr__(name):
+    """
+    Keeps `from scrape import pharmacies` etc. working, loading the data only when asked for
+    """
+    if name in LAST_SCRAPES:
+        return last_scrape(LAST_SCRAPES[name])
+    if name == 'last_pharmacies':
+        return last_snapshot(pharmacy)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
-async def fetch_register_page(sem, session, data_type, page):
+async def fetch_register_page(engine, data_type, page, quarantine=None, refresh=False):
     """
     Controls GET requests sent
-    :param sem: Semaphore value, to avoid overloading the website
-    :param session: current asyncio client session
+    :param engine: shared fetch engine (connection pool + adaptive concurrency limit), to avoid overloading the website
     :param data_type: assistant, pharmacist or pharmacy
     :param page: page of register to retrieve
-    :return: html reply
+    :param quarantine: list to add the page to if it still fails after retrying (raises if not given)
+    :param refresh: re-fetch from the website even if today's copy is cached
+    :return: html reply (None if quarantined)
     """
-    async with sem:
-        params = {'type': data_type, 'page': page}
-        reply = await session.get(BASE_URL, params=params)
-        html = await reply.text()
-        return html
+    params = {'type': data_type, 'page': page}
+    if REPLAY is not None:
+        return response_cache().replay(data_type, page, REPLAY)
+    try:
+        if CACHE_RESPONSES:
+            return await response_cache().fetch(engine, BASE_URL, params, data_type, page, today, refresh)
+        return await engine.get_text(BASE_URL, params=params)
+    except RETRYABLE_ERRORS as e:
+        if quarantine is None:
+            raise
+        tqdm.write(Fore.LIGHTRED_EX + f'Page {page} quarantined ({type(e).__name__})' + Fore.RESET)
+        quarantine.append(page)
+        return None
 
 
 def get_page(soup):
@@ -95,6 +214,40 @@ def get_page(soup):
     return int(p[1]), int(p[-1])
 
 
+def get_result_count(soup):
+    """
+    Returns number of records on the register ("1980 results found in ...")
+    :param soup: html converted to bs4 soup
+    :return: number of records (as integer)
+    """
+    return int(soup.select('.search-register-results .terms')[0].string.strip().replace(',', ''))
+
+
+def register_size(html):
+    """
+    Size of the register, from any page of it
+    :param html: html as returned from GET request
+    :return: last page, number of records (as integers)
+    """
+    soup = html_to_soup(html)
+    records = get_result_count(soup)
+    try:
+        return get_page(soup)[1], records
+    except IndexError:  # no pagination, it all fits on one page
+        return 1, records
+
+
+def expected_records(data_type, page):
+    """
+    :param data_type: assistant, pharmacist or pharmacy (pages and records read from page 1)
+    :param page: page number
+    :return: number of records the page should hold
+    """
+    if page < data_type.pages:
+        return PAGE_SIZE
+    return data_type.records - PAGE_SIZE * (data_type.pages - 1)
+
+
 def get_address(soup, s77r):
     """
     Extract address from html (incl. comments)
@@ -103,19 +256,42 @@ def get_address(soup, s77r):
     :return: cleaned up address string + bool (people) or None (pharmacy)
     """
     bs_comment = soup.find(text=lambda text: isinstance(text, bs4.Comment))
-    try:  # case pharmacist, assistant (pre 12/1/22) {big privacy leak!}
-        parsed_soup = bs4.BeautifulSoup(bs_comment, PARSER)
-        address = parsed_soup.small.string
-    except TypeError:  # case pharmacy
+    if bs_comment is not None:  # case pharmacist, assistant (pre 12/1/22) {big privacy leak!}
+        address = small_from_comment(bs_comment)
+    else:  # case pharmacy
         address = soup.small.string
         s77r = None
+    return clean_address(address), s77r
+
+
+def small_from_comment(comment):
+    """
+    Read the <small> string out of commented-out html, without parsing the comment
+    (falls back to parsing if the <small> holds tags or entities)
+    :param comment: text of the html comment
+    :return: string inside the first <small>, as bs4's .string would give it
+    """
+    start = comment.find('<small>')
+    end = comment.find('</small>', start)
+    if start != -1 and end != -1 and start == comment.find('<small'):
+        inner = comment[start + len('<small>'):end]
+        if '<' not in inner and '&' not in inner:
+            return inner.replace('\r\n', '\n').replace('\r', '\n')  # as the html parser does
+    return element_string(etree.HTML(comment).find('.//small'))
 
+
+def clean_address(address):
+    """
+    Tidy up an address as retrieved from the register
+    :param address: address string from the html
+    :return: cleaned up address string, or None if empty
+    """
     address = address.replace('\r\n', ', ')  # remove new line white space
     address = address.replace(' ,', ',')  # remove space before comma
     address = ' '.join(address.split())  # no double space
     if len(address) == 0:
         address = None
-    return address, s77r
+    return address
 
 
 def is_hospital_pharmacy(pharmacy_name):
@@ -176,6 +352,48 @@ def write_to_json(dump_data, file_name):
         json.dump(dump_data, output_file, indent=2)
 
 
+def write_snapshot(data_type, data_list, date_=None):
+    """
+    Write a scrape of a register to the data folder, in each of SNAPSHOT_FORMATS (see there)
+    :param data_type: assistant, pharmacist or pharmacy
+    :param data_list: a list of the data objects retrieved
+    :param date_: date of the scrape (YYYY-MM-DD), defaults to today
+    """
+    date_ = date_ or today
+    file_name = f'{DATA_DIR}/{data_type.json}-{date_}'
+    metrics = run_metrics()
+    if REPLAY is not None:  # leave the real snapshots alone
+        os.makedirs(f'{DATA_DIR}/replay', exist_ok=True)
+        with metrics.stage(f'{data_type}.write.json'):
+            write_to_json(data_list, file_name=f'{DATA_DIR}/replay/{data_type.json}-{REPLAY}.json')
+        return
+    keep_json = 'json' in SNAPSHOT_FORMATS
+    if keep_json or 'history' in SNAPSHOT_FORMATS:
+        with metrics.stage(f'{data_type}.write.json'):
+            write_to_json(data_list, file_name=f'{file_name}.json')
+            snapshot_catalog().add(str(data_type), date_, len(data_list))
+        if 'msgpack' in SNAPSHOT_FORMATS:  # after the json, so load_last_scrape sees it's up to date
+            from binary_snapshots import write_msgpack
+            with metrics.stage(f'{data_type}.write.msgpack'):
+                write_msgpack(data_list, f'{file_name}.msgpack')
+        elif os.path.exists(f'{file_name}.msgpack'):  # would no longer match the json
+            os.remove(f'{file_name}.msgpack')
+    if 'sqlite' in SNAPSHOT_FORMATS:
+        with metrics.stage(f'{data_type}.write.sqlite'), RegisterDB(data_path(DB_NAME)) as db:
+            db.load(str(data_type), date_, data_list)
+    if 'history' in SNAPSHOT_FORMATS:  # last, as it only takes days after those it holds
+        with metrics.stage(f'{data_type}.write.history'):
+            history = history_store(DATA_DIR, str(data_type), data_type.key)
+            dates = history.dates()
+            if dates and date_ <= dates[-1]:  # e.g. an older scrape rewritten (vacancy_dates.py --backfill)
+                print(Fore.YELLOW + f'{data_type} history runs to {dates[-1]}, {date_} not updated in it' + Fore.RESET)
+            else:
+                history.append(date_, data_list)
+        if not keep_json:
+            with metrics.stage(f'{data_type}.write.prune'):
+                prune(snapshot_catalog(), history, str(data_type))
+
+
 def html_to_soup(html):
     """
     Convert html to bs4 soup
@@ -243,37 +461,16 @@ def get_opening_hours(value_list):
                 }
     weekly_hours = 0
     for day in opening_hours:
-        hours_open = 0
-        try:
-            open_ = datetime.strptime(opening_hours[day]['Open'], '%H:%M')
-            closed = datetime.strptime(opening_hours[day]['Closed'], '%H:%M')
-            if open_ > closed > datetime(1900, 1, 1) or closed == datetime(1900, 1, 1, 10):
-                closed += timedelta(hours=12)
-            hours = (closed - open_) / timedelta(hours=1)
-            hours %= 24
-            # days_ = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
-            if day != 'Bank Holidays':
-                hours_open += hours
-            try:
-                lunch1 = datetime.strptime(opening_hours[day]['Lunch Closure'], '%H:%M')
-                lunch2 = datetime.strptime(opening_hours[day]['Lunch Reopen'], '%H:%M')
-                hours = (lunch2 - lunch1) / timedelta(hours=1)
-                if hours > 0:  # ignore incorrect (negative) lunch hours
-                    hours %= 24
-                    hours_open -= hours
-            except KeyError:  # no lunch
-                pass
-        except TypeError:  # no entry (closed)
-            pass
+        hours_open = day_hours(day, opening_hours[day])
         opening_hours[day]['Hours Open'] = hours_open
         weekly_hours += hours_open
     opening_hours['Weekly Hours'] = weekly_hours
     return opening_hours
 
 
-def data_from_soup(soup):
+def extract_from_soup(soup):
     """
-    Extract useful info from html converted to bs4 soup
+    Extract useful info from html converted to bs4 soup (without comparing against the last scrape)
     :param soup: input html soup
     :return: list of data retrieved (9 items for full page)
     """
@@ -303,80 +500,400 @@ def data_from_soup(soup):
         else:  # pharmacies
             data_object['Hospital'] = is_hospital_pharmacy(name)
             data_object['Other'] = is_other_pharmacy(name)
-            roles = ('Supervising', 'Superintendent')
-            pharmacy_ = next((ph for ph in pharmacies
-                              if ph['PSI Registration Number'] == data_object['PSI Registration Number']), None)
-            for role in roles:
-                vacant_since = f'{role} Pharmacist Vacant Since'
-                if data_object[f'{role} Pharmacist'] is None:
-                    try:
-                        if vacant_since not in pharmacy_.keys():  # newly vacant
-                            print(Fore.CYAN + f'New {role} Vacancy - '
-                                              f'{data_object["PSI Registration Number"]}: {name}, {address}.'
-                                              f' ({pharmacy_[f"{role} Pharmacist"]})')
-                            data_object[vacant_since] = today
-
-                        else:  # old vacancy
-                            data_object[vacant_since] \
-                                = pharmacy_[vacant_since]
-
-                    except AttributeError:  # new pharmacy
-                        data_object[vacant_since] = today
-                        print(Fore.GREEN + f'New {role} Vacancy (New Pharmacy) - '
-                                           f'{data_object["PSI Registration Number"]}: {name}, {address}')
-                else:
-                    try:
-                        if pharmacy_[f'{role} Pharmacist'] is None:
-                            print(Fore.CYAN + f'{role} Pharmacist Vacancy Filled - '
-                                              f'{data_object["PSI Registration Number"]}: {name}, {address}.'
-                                              f' ({data_object[f"{role} Pharmacist"]})')
-                    except TypeError:  # new pharmacy (with supervising/superintendent)
-                        print(Fore.WHITE + f'New Pharmacy {data_object["Name"]}, {data_object["Address"]}')
         data_object_list.append(data_object)
     return data_object_list
 
 
-async def get_data(data_type):
+def track_vacancies(data_object):
+    """
+    Carry supervising/superintendent vacancy dates over from the last scrape, and report any changes
+    :param data_object: pharmacy data retrieved (updated in place)
+    """
+    name = data_object['Name']
+    address = data_object.get('Address')
+    roles = ('Supervising', 'Superintendent')
+    pharmacy_ = last_snapshot(pharmacy).get(data_object['PSI Registration Number'])
+    for role in roles:
+        vacant_since = f'{role} Pharmacist Vacant Since'
+        if data_object[f'{role} Pharmacist'] is None:
+            try:
+                if vacant_since not in pharmacy_.keys():  # newly vacant
+                    print(Fore.CYAN + f'New {role} Vacancy - '
+                                      f'{data_object["PSI Registration Number"]}: {name}, {address}.'
+                                      f' ({pharmacy_[f"{role} Pharmacist"]})')
+                    data_object[vacant_since] = REPLAY or today  # date of the scrape
+
+                else:  # old vacancy
+                    data_object[vacant_since] \
+                        = pharmacy_[vacant_since]
+
+            except AttributeError:  # new pharmacy
+                data_object[vacant_since] = REPLAY or today  # date of the scrape
+                print(Fore.GREEN + f'New {role} Vacancy (New Pharmacy) - '
+                                   f'{data_object["PSI Registration Number"]}: {name}, {address}')
+        else:
+            try:
+                if pharmacy_[f'{role} Pharmacist'] is None:
+                    print(Fore.CYAN + f'{role} Pharmacist Vacancy Filled - '
+                                      f'{data_object["PSI Registration Number"]}: {name}, {address}.'
+                                      f' ({data_object[f"{role} Pharmacist"]})')
+            except TypeError:  # new pharmacy (with supervising/superintendent)
+                print(Fore.WHITE + f'New Pharmacy {data_object["Name"]}, {data_object["Address"]}')
+
+
+def add_vacancies(data_object_list):
+    """
+    Run track_vacancies over the pharmacies in a list of extracted data
+    :param data_object_list: data extracted from one page
+    :return: the same list, pharmacies updated with vacancy dates
+    """
+    for data_object in data_object_list:
+        if 'Section 77 Registration' not in data_object:  # pharmacies
+            track_vacancies(data_object)
+    return data_object_list
+
+
+def has_class(class_name):
+    """
+    XPath test for an element with a class, matching the way bs4's find_all(tag, class_name) does
+    :param class_name: css class
+    :return: XPath predicate
+    """
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+RESULT_ITEMS = etree.XPath(f"//div[{has_class('search-register-result-item')}]")
+AVATAR_CONTENT = etree.XPath(f"(.//div[{has_class('avatar-content')}])[1]")
+LABELS = etree.XPath(f".//p[{has_class('srchlbls')}]")
+COMMENTS = etree.XPath('.//comment()')
+TEXT = etree.XPath('.//text()')  # text nodes in document order, not comments
+
+
+def element_string(element):
+    """
+    lxml equivalent of bs4's Tag.string: the text if the element holds exactly one string
+    (directly or via a single child), otherwise None
+    :param element: lxml element
+    :return: string or None
+    """
+    children = [c for c in element]
+    contents = (1 if element.text else 0) + len(children) + sum(1 for c in children if c.tail)
+    if contents != 1:
+        return None
+    if element.text:
+        return str(element.text)
+    child = children[0]
+    if child.tag is etree.Comment:
+        return str(child.text)
+    return element_string(child)
+
+
+def stripped_strings(element):
+    """
+    lxml equivalent of bs4's Tag.stripped_strings
+    :param element: lxml element
+    :return: list of non-empty stripped strings, in document order
+    """
+    return [text for text in (str(t).strip() for t in TEXT(element)) if text]
+
+
+def extract_from_tree(tree):
+    """
+    Extract useful info from html parsed with lxml, visiting only the result items
+    (same output as extract_from_soup)
+    :param tree: root element of the page
+    :return: list of data retrieved (9 items for full page)
+    """
+    data_object_list = []
+    for item in RESULT_ITEMS(tree):
+        data_object = {}
+        avatar_content = AVATAR_CONTENT(item)[0]
+        name = element_string(avatar_content.find('.//h5'))
+        name, s77r = section77(name)
+        comments = COMMENTS(avatar_content)
+        if comments:  # case pharmacist, assistant (pre 12/1/22)
+            address = small_from_comment(comments[0].text)
+        else:  # case pharmacy
+            address = element_string(avatar_content.find('.//small'))
+            s77r = None
+        address = clean_address(address)
+        data_object['Name'] = ' '.join(name.split())
+        if address:
+            data_object['Address'] = address
+        for label in LABELS(item):
+            kv_list = stripped_strings(label)
+            key = kv_list[0][:-1]  # remove trailing colon
+            if key == 'Opening Hours':
+                value = get_opening_hours(kv_list[1:])
+            else:
+                value = value_converter(kv_list)
+            data_object[key] = value
+        if s77r is not None:  # pharmacists, assistants (value can be False)
+            data_object['Section 77 Registration'] = s77r
+        else:  # pharmacies
+            data_object['Hospital'] = is_hospital_pharmacy(name)
+            data_object['Other'] = is_other_pharmacy(name)
+        data_object_list.append(data_object)
+    return data_object_list
+
+
+def extract_page(html, engine=None):
+    """
+    Convert one page of the register to data, without comparing against the last scrape
+    (safe to run in a worker process, returns plain dicts)
+    :param html: html as returned from GET request
+    :param engine: 'xpath' or 'bs4', defaults to PARSE_ENGINE
+    :return: list of data retrieved (9 items for full page)
+    """
+    if engine is None:
+        engine = PARSE_ENGINE
+    if engine == 'xpath':
+        return extract_from_tree(etree.HTML(html))
+    return extract_from_soup(html_to_soup(html))
+
+
+def page_digest(html):
+    """
+    Hash of the part of a page holding the register entries (from the first result item to the pagination),
+    so anything else on the page changing doesn't count
+    :param html: html as returned from GET request
+    :return: sha256 hex digest
+    """
+    start = html.find('search-register-result-item')
+    end = html.find('pagination-description', max(start, 0))
+    return hashlib.sha256(html[start:end].encode()).hexdigest()
+
+
+class PageHashes:
     """
-    Assembles all tasks (i.e. GET requests) into a list, and converts to useful data
+    Content hash and registration numbers of each page, this run's and the last run's,
+    so pages that haven't changed reuse the last scrape's records instead of being parsed
+    """
+
+    def __init__(self, data_type, incremental=True):
+        """
+        :param data_type: assistant, pharmacist or pharmacy
+        :param incremental: reuse unchanged pages (hashes are saved for the next run either way)
+        """
+        self.data_type = data_type
+        self.previous = self.load() if incremental else {}
+        self.current = {}  # page -> (digest, registration numbers)
+        self.reused = set()
+
+    def load(self):
+        """
+        Page hashes saved by the last run, if they describe the snapshot last_snapshot loads (not so after a
+        rerun today, a run that failed before writing its snapshot, or a snapshot deleted since)
+        :return: dict of page number to (digest, registration numbers), empty if there's nothing to reuse
+        """
+        try:
+            with open(data_path(PAGE_HASHES_FILE)) as file:
+                saved = json.load(file).get(str(self.data_type))
+            if saved is None or saved.get('snapshot') != last_snapshot(self.data_type).date:
+                return {}
+        except FileNotFoundError:  # no hashes, or no last scrape
+            return {}
+        return {int(page): tuple(entry) for page, entry in saved['pages'].items()}
+
+    def save(self):
+        """
+        Save this run's page hashes for the next run, once the snapshot they describe is written
+        """
+        try:
+            with open(data_path(PAGE_HASHES_FILE)) as file:
+                saved = json.load(file)
+        except FileNotFoundError:
+            saved = {}
+        pages = {str(page): list(entry) for page, entry in sorted(self.current.items())}
+        saved[str(self.data_type)] = {'snapshot': today, 'pages': pages}
+        with open(data_path(PAGE_HASHES_FILE), 'w') as file:
+            json.dump(saved, file)
+
+    def reuse(self, page, digest):
+        """
+        Records of a page from the last scrape, if the page is unchanged since
+        :param page: page number
+        :param digest: page_digest of the page now
+        :return: list of data objects, or None if the page has to be parsed
+        """
+        previous = self.previous.get(page)
+        if previous is None or previous[0] != digest:
+            return None
+        snapshot = last_snapshot(self.data_type)
+        if not all(r in snapshot for r in previous[1]):
+            return None
+        self.reused.add(page)
+        data = [snapshot[r] for r in previous[1]]
+        return to_dicts(data) if COMPACT_RECORDS else data
+
+    def record(self, page, digest, data_object_list):
+        """
+        :param page: page number
+        :param digest: page_digest of the page
+        :param data_object_list: records on the page
+        """
+        self.current[page] = (digest, [d.get(self.data_type.key) for d in data_object_list])
+
+
+async def fetch_into_queue(engine, data_type, page, quarantine, queue, slots, refresh=False):
+    """
+    Producer: fetch a page and hand it to the parser. A slot is taken before fetching and given back once
+    the page is parsed, so no more than PARSE_QUEUE_SIZE pages of html are held at once
+    :param engine: open fetch engine
     :param data_type: assistant, pharmacist or pharmacy
-    :return: no return value, writes retrieved data to JSON file
+    :param page: page of register to retrieve
+    :param quarantine: list of pages that failed after retrying (None raises instead)
+    :param queue: queue of (page, html) read by parse_from_queue
+    :param slots: semaphore of PARSE_QUEUE_SIZE, released by parse_from_queue
+    :param refresh: bypass today's cached copy (for re-fetches)
     """
+    await slots.acquire()
+    try:
+        with run_metrics().stage(f'{data_type}.fetch'):  # waiting for a request slot included
+            html = await fetch_register_page(engine, data_type.type, page, quarantine, refresh)
+    except BaseException:
+        slots.release()
+        raise
+    if html is None:
+        slots.release()
+    else:
+        await queue.put((page, html))
+
+
+async def parse_from_queue(queue, pages, executor, page_hashes=None, slots=None):
+    """
+    Consumer: parse pages as they arrive, keeping only the data (the html is dropped once parsed)
+    :param queue: queue of (page, html) filled by fetch_into_queue
+    :param pages: dict of page number to list of data (or the exception raised parsing it)
+    :param executor: executor that runs the parsing, so the event loop keeps fetching meanwhile
+    :param page_hashes: PageHashes of the register, to skip parsing unchanged pages (None parses every page)
+    :param slots: semaphore to release as each page is parsed (see fetch_into_queue)
+    """
+    loop = asyncio.get_running_loop()
+    metrics = run_metrics()
+    register = page_hashes.data_type if page_hashes is not None else 'register'
+    while True:
+        page, html = await queue.get()
+        try:
+            digest = page_digest(html) if page_hashes is not None else None
+            data_object_list = page_hashes.reuse(page, digest) if page_hashes is not None else None
+            if data_object_list is None:
+                with metrics.stage(f'{register}.parse'):
+                    if metrics.profiled(f'{register}.parse'):  # profilers only see their own thread
+                        data_object_list = extract_page(html, PARSE_ENGINE)
+                    else:
+                        data_object_list = await loop.run_in_executor(executor, extract_page, html, PARSE_ENGINE)
+                with metrics.stage(f'{register}.vacancies'):
+                    data_object_list = add_vacancies(data_object_list)  # needs the last scrape, so never in a worker
+                metrics.count(f'{register}.pages parsed')
+            else:
+                metrics.count(f'{register}.pages reused')
+            pages[page] = data_object_list
+            if page_hashes is not None:
+                page_hashes.record(page, digest, data_object_list)
+        except Exception as e:  # keep draining the queue, or fetches waiting on it never finish
+            pages[page] = e
+        finally:
+            del html
+            queue.task_done()
+            if slots is not None:
+                slots.release()
+
+
+def parse_executor(parse_workers):
+    """
+    Choose where pages are parsed
+    :param parse_workers: number of worker processes, 0 for a single thread in this process
+    :return: executor, number of consumers to keep it busy
+    """
+    if parse_workers > 0:
+        return ProcessPoolExecutor(max_workers=parse_workers), parse_workers
+    return ThreadPoolExecutor(max_workers=1), 1
 
-    async with ClientSession() as session:
-
-        tasks = [asyncio.ensure_future(
-            fetch_register_page(
-                asyncio.Semaphore(semaphore_pause),
-                # seems to work fine at any number, but lower if script is overloading PSI website
-                session, data_type.type,
-                i)) for i in range(1, data_type.pages + 1)]
-
-        # tdqm progress bar
-        t = tqdm(asyncio.as_completed(tasks), total=len(tasks), delay=2)
-        for n, r in enumerate(t, start=1):
-            t.set_description(f"Getting data on page {n} of {data_type} register")
-            # update description to match progress bar (not quite accurate)
-            await r
-
-        html_list = await asyncio.gather(*tasks)
-        soup_map = (html_to_soup(h) for h in html_list)
-        data_map = (data_from_soup(s) for s in soup_map)
-        flat_list = list(chain.from_iterable(data_map))
-        if data_type.__str__() == 'pharmacy':
-            regs_new = [x['PSI Registration Number'] for x in flat_list]
-            regs_old = [x['PSI Registration Number'] for x in pharmacies]
-            removed = [x for x in pharmacies
-                       if x['PSI Registration Number'] in regs_old
-                       and x['PSI Registration Number'] not in regs_new]
-            added = [x for x in flat_list
-                     if x['PSI Registration Number'] in regs_new
-                     and x['PSI Registration Number'] not in regs_old]
-            for r in removed:
-                print(f"Removed - {r['PSI Registration Number']}: {r['Name']}, {r['Address']}.")
-            for a in added:
-                print(f"Added - {a['PSI Registration Number']}: {a['Name']}, {a['Address']}.")
-        write_to_json(flat_list, file_name=f"data/{data_type.json}-{today}.json")
+
+async def get_data(data_type, engine, parse_workers=None, incremental=None):
+    """
+    Fetches every page of a register, parsing each page as soon as it arrives, and converts to useful data
+    :param data_type: assistant, pharmacist or pharmacy
+    :param engine: open fetch engine, shared by every register in the run
+    :param parse_workers: worker processes for parsing (0 to parse in a thread), defaults to PARSE_WORKERS
+    :param incremental: reuse the last scrape for unchanged pages, defaults to INCREMENTAL
+    :return: no return value, writes retrieved data to JSON file
+    """
+    if parse_workers is None:
+        parse_workers = PARSE_WORKERS
+    if incremental is None:
+        incremental = INCREMENTAL
+    quarantine = []
+    pages = {}
+    page_hashes = PageHashes(data_type, incremental and REPLAY is None)  # a replay is for re-parsing
+    queue = asyncio.Queue()
+    slots = asyncio.Semaphore(PARSE_QUEUE_SIZE)  # pages fetching or waiting to be parsed
+    executor, consumer_count = parse_executor(parse_workers)
+    tasks = []
+    with executor:
+        consumers = [asyncio.ensure_future(parse_from_queue(queue, pages, executor, page_hashes, slots))
+                     for _ in range(consumer_count)]
+        try:
+            await slots.acquire()
+            html = await fetch_register_page(engine, data_type.type, 1)  # page 1 says how big the register is
+            data_type.pages, data_type.records = register_size(html)
+            await queue.put((1, html))
+            del html
+            tasks += [asyncio.ensure_future(fetch_into_queue(engine, data_type, i, quarantine, queue, slots))
+                      for i in range(2, data_type.pages + 1)]
+
+            # tdqm progress bar
+            t = tqdm(asyncio.as_completed(tasks), total=len(tasks), delay=2)
+            for n, r in enumerate(t, start=1):
+                t.set_description(f"Getting data on page {n} of {data_type} register")
+                # update description to match progress bar (not quite accurate)
+                await r
+
+            for page in sorted(quarantine):  # one more go at pages that kept failing, once the rush is over
+                print(Fore.YELLOW + f'Re-fetching page {page} of {data_type} register')
+                await fetch_into_queue(engine, data_type, page, None, queue, slots, refresh=True)
+            await queue.join()
+
+            for attempt in range(SHORT_PAGE_RETRIES + 1):  # pages with records missing, e.g. cut short by the server
+                short = [page for page in sorted(pages) if not isinstance(pages[page], Exception)
+                         and len(pages[page]) < expected_records(data_type, page)]
+                if CACHE_RESPONSES and REPLAY is None:
+                    for page in short:  # not a copy to keep, or to answer the re-fetch with
+                        response_cache().discard(data_type.type, page, today)
+                if attempt == SHORT_PAGE_RETRIES or REPLAY is not None:  # a replay would re-read the same copy
+                    break
+                for page in short:
+                    run_metrics().count(f'{data_type}.short pages')
+                    print(Fore.YELLOW + f'Re-fetching page {page} of {data_type} register'
+                                        f' ({len(pages[page])} of {expected_records(data_type, page)} records)')
+                    await fetch_into_queue(engine, data_type, page, None, queue, slots, refresh=True)
+                await queue.join()
+        finally:  # e.g. a page not in the cache in replay mode: nothing left running
+            for task in tasks + consumers:
+                task.cancel()
+            await asyncio.gather(*tasks, *consumers, return_exceptions=True)
+
+    for page in sorted(pages):
+        if isinstance(pages[page], Exception):
+            raise pages[page]
+    flat_list = list(chain.from_iterable(pages[page] for page in sorted(pages)))
+    metrics = run_metrics()
+    metrics.count(f'{data_type}.pages', len(pages))
+    metrics.count(f'{data_type}.records', len(flat_list))
+    metrics.count(f'{data_type}.quarantined', len(quarantine))
+    if len(flat_list) != data_type.records:  # e.g. the register changed mid-crawl, shifting records between pages
+        print(Fore.LIGHTRED_EX + f'{data_type} register has {data_type.records} records, {len(flat_list)} retrieved')
+    if page_hashes.previous:
+        print(Fore.WHITE + f'{len(page_hashes.reused)} of {len(pages)} pages of {data_type} register unchanged,'
+                           f' not parsed')
+    if data_type.__str__() == 'pharmacy':
+        with metrics.stage(f'{data_type}.diff'):
+            print_diff(diff_snapshots(last_snapshot(pharmacy), RegisterSnapshot(flat_list, data_type.key)),
+                       data_type.key)
+    write_snapshot(data_type, flat_list)
+    if REPLAY is None:
+        page_hashes.save()
 
 
 def time_conv(t):
@@ -393,6 +910,53 @@ def time_conv(t):
     return t
 
 
+async def get_all_data(data_types):
+    """
+    Retrieve each register in turn, sharing one fetch engine between them
+    :param data_types: registers to retrieve
+    :return: no return value, writes retrieved data to JSON files (and a run report, see write_run_report)
+    """
+    global _metrics
+    _metrics = metrics = RunMetrics(PROFILE_STAGES, PROFILER)
+    async with FetchEngine(state_file=data_path(RATE_LIMIT_FILE), metrics=metrics) as engine:
+        for x in data_types:
+            start = time.perf_counter()
+            bytes_before = engine.bytes
+            with metrics.stage(f'{x}'):
+                await get_data(x, engine)
+            metrics.count(f'{x}.bytes downloaded', engine.bytes - bytes_before)
+            metrics.gauge(f'{x}.peak_rss_mb so far', peak_rss_mb())  # high-water mark of the whole run, not x's own
+            time_elapsed = time_conv(time.perf_counter() - start)
+            print(Fore.WHITE + f'{x} data retrieved in {time_elapsed}')
+            await asyncio.sleep(1)
+        metrics.gauge('concurrency limit', engine.limiter.limit)
+    if CACHE_RESPONSES or REPLAY is not None:
+        cache = response_cache()
+        print(Fore.WHITE + f'Page cache: {cache.hits} hits, {cache.not_modified} not modified, {cache.misses} fetched')
+        metrics.count('cache hits', cache.hits)
+        if REPLAY is None:
+            cache.evict()
+            cache.save()
+    write_run_report(metrics)
+
+
+def write_run_report(metrics):
+    """
+    Write the run's measurements next to the snapshots, as run-report-<date>.json (plus any stage profiles)
+    :param metrics: RunMetrics of the run
+    """
+    folder = DATA_DIR if REPLAY is None else f'{DATA_DIR}/replay'
+    file_name = f'{folder}/run-report-{REPLAY or today}.json'
+    profiles = metrics.write(file_name)
+    report = metrics.report()
+    for name, stage in report['stages'].items():
+        per_call = f" ({stage['count']} x {1000 * stage['mean']:.1f}ms, p95 {1000 * stage['p95']:.1f}ms)"
+        print(Fore.WHITE + f"{name}: {stage['total']:.2f}s" + (per_call if stage['count'] > 1 else ''))
+    print(Fore.WHITE + f"Run report written to {file_name} (peak RSS {report['peak_rss_mb'] or 0:.0f}MB)")
+    for profile in profiles:
+        print(Fore.WHITE + f'Profile written to {profile}')
+
+
 # noinspection PyTypeChecker
 def run():
     """
@@ -401,23 +965,34 @@ def run():
     """
     try:
         loop = asyncio.get_event_loop()
-        for x in (
-                assistant,
-                # pharmacist,
-                pharmacy
-        ):
-            start = time.perf_counter()
-            loop.run_until_complete(get_data(x))
-            time_elapsed = time_conv(time.perf_counter() - start)
-            print(Fore.WHITE + f'{x} data retrieved in {time_elapsed}')
-            time.sleep(1)
+        loop.run_until_complete(get_all_data((
+            assistant,
+            # pharmacist,
+            pharmacy
+        )))
         return 1
-    except ClientPayloadError as e:
-        print(Fore.LIGHTRED_EX + e)
+    except RETRYABLE_ERRORS as e:  # a page failed even after retries and quarantine
+        print(Fore.LIGHTRED_EX + f'{type(e).__name__}: {e}')
+        return 0
+    except CacheMiss as e:  # replay mode: a page of the replayed date was never cached
+        print(Fore.LIGHTRED_EX + f'Replay of {REPLAY} stopped, {e}')
         return 0
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scrape the PSI registers')
+    parser.add_argument('--replay', metavar='DATE', help='re-run from pages cached on or before DATE, offline')
+    parser.add_argument('--cache', action='store_true', help='keep raw pages (revalidated with ETag/Last-Modified)')
+    parser.add_argument('--profile', action='append', default=[], metavar='STAGE',
+                        help='profile a stage of the run, e.g. pharmacy.parse (see the run report for stage names)')
+    parser.add_argument('--profiler', choices=('cProfile', 'pyinstrument'), default=PROFILER)
+    parser.add_argument('--compact', action='store_true', help='hold the last scrapes as compact records')
+    args = parser.parse_args()
+    REPLAY = args.replay
+    CACHE_RESPONSES = args.cache
+    PROFILE_STAGES = tuple(args.profile)
+    PROFILER = args.profiler
+    COMPACT_RECORDS = args.compact
     exit_code = run()  # 1 - success, 0 - exception triggered
     total_time_elapsed = time_conv(time.perf_counter() - start_global)
     print(Fore.YELLOW + f'Total time taken: {total_time_elapsed}')
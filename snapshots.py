@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+import re
+from bisect import bisect_left, bisect_right
+
+SNAPSHOT_FILE = re.compile(r'^(?P<type>[a-z]+)-data-(?P<date>\d{4}-\d{2}-\d{2})\.json$')
+MANIFEST = 'manifest.json'
+
+
+class RegisterSnapshot:
+    """
+    One scrape of a register, indexed by registration number for O(1) lookups
+    """
+
+    def __init__(self, records, key='PSI Registration Number', date_=None):
+        """
+        :param records: list of data objects, as written by write_to_json
+        :param key: field holding the registration number
+        :param date_: date of the scrape (YYYY-MM-DD), if known
+        """
+        self.records = records
+        self.key = key
+        self.date = date_
+        self.index = {}
+        for record in records:
+            self.index.setdefault(record[key], record)  # first match wins, as a linear scan would
+
+    @classmethod
+    def from_json(cls, file_name, key='PSI Registration Number'):
+        """
+        Load a snapshot from a JSON file
+        :param file_name: name of json file
+        :param key: field holding the registration number
+        :return: RegisterSnapshot
+        """
+        with open(file_name) as file:
+            return cls(json.load(file), key)
+
+    def get(self, registration_number, default=None):
+        """
+        Look up a record by registration number
+        :param registration_number: registration number
+        :param default: value returned if the record isn't in the snapshot
+        :return: data object or default
+        """
+        return self.index.get(registration_number, default)
+
+    def registration_numbers(self):
+        """
+        :return: set of registration numbers in the snapshot
+        """
+        return set(self.index)
+
+    def __getitem__(self, registration_number):
+        return self.index[registration_number]
+
+    def __contains__(self, registration_number):
+        return registration_number in self.index
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+
+def file_checksum(file_name):
+    """
+    :param file_name: file to hash
+    :return: sha256 hex digest of the file's contents
+    """
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class SnapshotCatalog:
+    """
+    Index of the snapshots in the data folder (type, date, record count, checksum), kept in a manifest
+    so finding the latest snapshot, or the one for a date, is a single lookup
+    """
+
+    def __init__(self, data_dir='data', manifest=MANIFEST):
+        """
+        :param data_dir: folder holding the <type>-data-<date>.json snapshots
+        :param manifest: name of the manifest file inside data_dir
+        """
+        self.data_dir = data_dir
+        self.manifest = os.path.join(data_dir, manifest)
+        self.entries = {}  # file name -> entry
+        self._dates = {}  # type -> sorted list of dates
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reload the manifest and reconcile it with one scan of the data folder, reading only files
+        that are new or have changed since they were catalogued
+        """
+        try:
+            with open(self.manifest) as file:
+                known = {entry['file']: entry for entry in json.load(file)}
+        except FileNotFoundError:
+            known = {}
+        entries = {}
+        try:
+            scan = list(os.scandir(self.data_dir))
+        except FileNotFoundError:
+            scan = []
+        for dir_entry in scan:
+            match = SNAPSHOT_FILE.match(dir_entry.name)
+            if not match:
+                continue
+            stat = dir_entry.stat()
+            entry = known.get(dir_entry.name)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                with open(dir_entry.path) as file:
+                    records = len(json.load(file))
+                entry = self._entry(dir_entry.name, match['type'], match['date'], records)
+            entries[dir_entry.name] = entry
+        changed = entries != known
+        self.entries = entries
+        self._index()
+        if changed and scan:
+            self.save()
+
+    def _entry(self, file_name, type_, date_, records):
+        path = os.path.join(self.data_dir, file_name)
+        stat = os.stat(path)
+        return {'file': file_name, 'type': type_, 'date': date_, 'records': records,
+                'sha256': file_checksum(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def _index(self):
+        self._dates = {}
+        for entry in self.entries.values():
+            self._dates.setdefault(entry['type'], []).append(entry['date'])
+        for dates in self._dates.values():
+            dates.sort()
+
+    def save(self):
+        """
+        Write the manifest
+        """
+        entries = sorted(self.entries.values(), key=lambda e: (e['type'], e['date']))
+        with open(self.manifest, 'w') as file:
+            json.dump(entries, file, indent=2)
+
+    def add(self, type_, date_, records):
+        """
+        Catalogue a snapshot that has just been written
+        :param type_: assistant, pharmacist or pharmacy
+        :param date_: date of the scrape (YYYY-MM-DD)
+        :param records: number of records in the snapshot
+        :return: catalogue entry
+        """
+        entry = self._entry(f'{type_}-data-{date_}.json', type_, date_, records)
+        self.entries[entry['file']] = entry
+        self._index()
+        self.save()
+        return entry
+
+    def path(self, entry):
+        """
+        :param entry: catalogue entry
+        :return: path of the snapshot file
+        """
+        return os.path.join(self.data_dir, entry['file'])
+
+    def get(self, type_, date_):
+        """
+        :param type_: assistant, pharmacist or pharmacy
+        :param date_: date of the scrape (YYYY-MM-DD)
+        :return: catalogue entry, or None if there's no snapshot for that date
+        """
+        return self.entries.get(f'{type_}-data-{date_}.json')
+
+    def as_of(self, type_, date_):
+        """
+        Most recent snapshot taken on or before a date
+        :param type_: assistant, pharmacist or pharmacy
+        :param date_: date (YYYY-MM-DD)
+        :return: catalogue entry
+        """
+        dates = self._dates.get(type_, [])
+        i = bisect_right(dates, date_)
+        if i == 0:
+            raise FileNotFoundError(f'No {type_} snapshot in {self.data_dir} on or before {date_}')
+        return self.get(type_, dates[i - 1])
+
+    def latest(self, type_):
+        """
+        :param type_: assistant, pharmacist or pharmacy
+        :return: catalogue entry of the most recent snapshot
+        """
+        dates = self._dates.get(type_)
+        if not dates:
+            raise FileNotFoundError(f'No {type_} snapshot in {self.data_dir}')
+        return self.get(type_, dates[-1])
+
+    def in_range(self, type_, start, end):
+        """
+        :param type_: assistant, pharmacist or pharmacy
+        :param start: first date (YYYY-MM-DD), inclusive
+        :param end: last date (YYYY-MM-DD), inclusive
+        :return: catalogue entries in date order
+        """
+        dates = self._dates.get(type_, [])
+        return [self.get(type_, d) for d in dates[bisect_left(dates, start):bisect_right(dates, end)]]
@@ -1,33 +1,137 @@
+"""
+Vacancy dates from the PSI's FOI replies (No SV.json, No SI.json, No SI & SV.json, see excel_reader.py)
+checked against a pharmacy scrape, both ways, e.g.
+python vacancy_dates.py (latest scrape)
+python vacancy_dates.py --date 2022-03-01 --backfill (FOI dates written into that scrape's Vacant Since fields)
+"""
+import argparse
 import json
-from scrape import today
-from datetime import datetime, timedelta
-last_scrape_date = today
-with open(f'data/pharmacy-data-{last_scrape_date}.json') as file:
-    pharmacies = json.load(file)
-with open(f'No SV.json') as file:
-    foi_no_supervising = json.load(file)
-
-print(len(pharmacies))
-no_supervising = [pharmacy for pharmacy in pharmacies if pharmacy['Supervising Pharmacist'] is None]
-for foi_pharmacy in foi_no_supervising:
-    date_removed = foi_pharmacy['Date removed']
-    try:
-        pharmacy = next(p for p in pharmacies if foi_pharmacy['Reg'] == p['PSI Registration Number'])
-    except StopIteration:
-        pharmacy = None
-        print(foi_pharmacy , 1)
-    try:
-        vacant_since = pharmacy.get('Supervising Pharmacist Vacant Since', None)
-    except AttributeError:
-        vacant_since = None
-        print(foi_pharmacy, 0)
-
-
-    if vacant_since is not None and vacant_since != date_removed:
-        vacant_since_TD = datetime.strptime(vacant_since, '%Y-%m-%d')
-        date_removed_TD = datetime.strptime(date_removed, '%Y-%m-%d')
-        if vacant_since_TD == date_removed_TD:
-            print(pharmacy['Name'], vacant_since, date_removed, (vacant_since_TD - date_removed_TD) / timedelta(days=1))
-            pharmacy['Superintendent Pharmacist Vacant Since'] = date_removed
-# with open(f'data/pharmacy-data-{last_scrape_date}.json', 'w') as json_file:
-#     json.dump(pharmacies, json_file, indent=2)
+import os
+
+from colorama import Fore
+
+import scrape
+from excel_reader import FOI_DIR
+from snapshots import RegisterSnapshot
+
+FOI_FILES = {  # FOI file -> roles the pharmacies in it were left without
+    'No SV': ('Supervising',),
+    'No SI': ('Superintendent',),
+    'No SI & SV': ('Superintendent', 'Supervising'),
+}
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))  # where the first FOI replies were committed
+
+
+def load_foi(foi_dir=FOI_DIR):
+    """
+    The FOI vacancies, by registration number and role
+    :param foi_dir: folder holding the FOI json files (files not there are skipped; for the default folder,
+        files not there are looked for in the repo folder)
+    :return: dict of (registration number, role) to FOI row
+    """
+    folders = (foi_dir, REPO_DIR) if foi_dir == FOI_DIR else (foi_dir,)
+    vacancies = {}
+    found = 0
+    for name, roles in FOI_FILES.items():
+        file_name = next((f for f in (os.path.join(folder, f'{name}.json') for folder in folders)
+                          if os.path.exists(f)), None)
+        if file_name is None:
+            print(Fore.YELLOW + f'{name}.json not in {" or ".join(folders)}, skipped' + Fore.RESET)
+            continue
+        found += 1
+        with open(file_name) as file:
+            rows = json.load(file)
+        for row in rows:
+            for role in roles:
+                vacancies[row['Reg'], role] = row
+    if not found:
+        raise FileNotFoundError(f'No FOI files ({", ".join(f"{name}.json" for name in FOI_FILES)}) in'
+                                f' {" or ".join(folders)}, see excel_reader.py to make them')
+    return vacancies
+
+
+def reconcile(vacancies, pharmacies):
+    """
+    Join the FOI vacancies to a scrape by registration number, in one pass of each
+    :param vacancies: from load_foi
+    :param pharmacies: RegisterSnapshot of pharmacies
+    :return: list of (registration number, role, problem, FOI date, scrape date), where problem is one of
+        'not on register': in the FOI, not in the scrape
+        'filled': in the FOI, but the scrape has a pharmacist in the role
+        'no date': vacant in both, the scrape has no Vacant Since
+        'no FOI date': vacant in both, the FOI has no Date removed
+        'earlier in FOI' / 'later in FOI': vacant in both, on different dates
+        'not in FOI': vacant in the scrape, not in the FOI
+    """
+    problems = []
+    for (registration_number, role), row in vacancies.items():
+        date_removed = row['Date removed']
+        pharmacy = pharmacies.get(registration_number)
+        if pharmacy is None:
+            problems.append((registration_number, role, 'not on register', date_removed, None))
+            continue
+        vacant_since = pharmacy.get(f'{role} Pharmacist Vacant Since')
+        if pharmacy.get(f'{role} Pharmacist') is not None:
+            problems.append((registration_number, role, 'filled', date_removed, vacant_since))
+        elif vacant_since is None:
+            problems.append((registration_number, role, 'no date', date_removed, None))
+        elif date_removed is None:
+            problems.append((registration_number, role, 'no FOI date', None, vacant_since))
+        elif vacant_since != date_removed:
+            problem = 'earlier in FOI' if date_removed < vacant_since else 'later in FOI'
+            problems.append((registration_number, role, problem, date_removed, vacant_since))
+    for pharmacy in pharmacies:
+        for role in ('Superintendent', 'Supervising'):
+            registration_number = pharmacy['PSI Registration Number']
+            if pharmacy.get(f'{role} Pharmacist') is None and (registration_number, role) not in vacancies:
+                problems.append((registration_number, role, 'not in FOI', None,
+                                 pharmacy.get(f'{role} Pharmacist Vacant Since')))
+    return problems
+
+
+def backfill(problems, pharmacies):
+    """
+    Take the FOI's date where the scrape has none, or a later one (it only knows when it first saw the vacancy)
+    :param problems: from reconcile
+    :param pharmacies: RegisterSnapshot of pharmacies (records updated in place)
+    :return: number of Vacant Since fields set
+    """
+    updated = 0
+    for registration_number, role, problem, date_removed, _ in problems:
+        if problem in ('no date', 'earlier in FOI'):
+            pharmacies[registration_number][f'{role} Pharmacist Vacant Since'] = date_removed
+            updated += 1
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--date', help='date of the pharmacy scrape (default: the latest)')
+    parser.add_argument('--foi-dir', default=FOI_DIR)
+    parser.add_argument('--backfill', action='store_true', help='write FOI dates into the scrape')
+    args = parser.parse_args()
+    date_, records = scrape.load_last_scrape(scrape.pharmacy, args.date or scrape.today)  # json or the history
+    if args.date and date_ != args.date:
+        raise FileNotFoundError(f'No pharmacy scrape for {args.date} in {scrape.DATA_DIR} (latest before: {date_})')
+    pharmacies = RegisterSnapshot(records, scrape.pharmacy.key, date_)
+    problems = reconcile(load_foi(args.foi_dir), pharmacies)
+    colours = {'not on register': Fore.WHITE, 'filled': Fore.GREEN, 'not in FOI': Fore.MAGENTA}
+    for registration_number, role, problem, date_removed, vacant_since in sorted(
+            problems, key=lambda p: (p[2], p[1], str(p[0]))):
+        pharmacy = pharmacies.get(registration_number) or {}
+        print(colours.get(problem, Fore.CYAN) + f'{problem} ({role}) - {registration_number}: '
+                                                 f"{pharmacy.get('Name')}, {pharmacy.get('Address')}."
+                                                 f' FOI {date_removed}, scrape {vacant_since}' + Fore.RESET)
+    counts = {}
+    for problem in problems:
+        counts[problem[2]] = counts.get(problem[2], 0) + 1
+    print(', '.join(f'{n} {problem}' for problem, n in sorted(counts.items())) or 'FOI and scrape agree')
+    if args.backfill:
+        updated = backfill(problems, pharmacies)
+        if updated:
+            scrape.write_snapshot(scrape.pharmacy, pharmacies.records, date_)
+        print(Fore.GREEN + f'{updated} Vacant Since dates backfilled into the {date_} scrape' + Fore.RESET)
+
+
+if __name__ == '__main__':
+    main()